@@ -2,6 +2,12 @@
 merger
 
 Description: Merge all the dataframes together.
+
+Usage: python merger.py [--start yyyymmdd] [--end yyyymmdd]
+
+--start and --end only merge the packages with an event in the dates
+given. The whole history of those packages is merged, events outside
+of the dates included, so their labels are the same as in a full merge.
 """
 
 import os
@@ -11,13 +17,19 @@ import numpy as np
 import warnings
 from tqdm import tqdm
 
+# compact column types of the compiled dataframes
+from schema import DATE_DTYPE, apply_schema
+
+# files of the compiled dataframes
+from storage import date_rows, read_dataframe, write_dataframe
+
 # ignore warnings
 warnings.filterwarnings('ignore')
 
 
 def compress(df_master):
-    # make a copy of the master dataframe
-    df = df_master.copy()
+    # make a copy of the master dataframe, it is only read so the columns are shared
+    df = df_master.copy(deep=False)
     
     # create an array of all our unique package IDs
     master_idx = pd.unique(df_master['package_id'])
@@ -186,84 +198,48 @@ def add_package(df_master, df_package):
     
     
 def add_aggregate(df_master, df_aggregate):
-    # get a copy of the master dataframe
-    df = df_master.copy()
+    # get a copy of the master dataframe, columns are only added so they are shared
+    df = df_master.copy(deep=False)
     
-    # create arrays for new columns
-    total_count_array = np.full(len(df), 0, dtype='int')
+    # total number of packages for every date
+    day_totals = df_aggregate.groupby('date')['pkg_counts'].sum()
     
-    # insert blank column into dataframe
-    df.insert(loc=len(df.columns), column='total_day_pkgs', value=total_count_array)
+    # the first entry of every package's date gets the total
+    first = ~df.duplicated(subset=['package_id', 'date'], keep='first').to_numpy()
     
-    # get the unique package IDs from the dataframe
-    master_idx = pd.unique(df['package_id'])
+    # join the totals on the integer dates, dates without aggregate data have 0
+    totals = df['date'].map(day_totals).fillna(0).to_numpy().astype('int')
+    total_count_array = np.where(first, totals, 0)
     
-    # loop over all the packages and total number of day packages
-    for i in tqdm(master_idx):
-        # get the package's history
-        pkg = df[df['package_id'] == i]
-        
-        # get the unique dates
-        dates = pd.unique(pkg['date'])
-        
-        for d in dates:
-            # get the aggregate data for the date
-            df_agg = df_aggregate[df_aggregate['date'] == d]
-            
-            # get the total number of packages
-            total_pkgs = sum(df_agg['pkg_counts'])        
-            
-            # insert the new information into the dataframe
-            pkg_date_index = pkg[pkg['date'] == d].index        
-            df.at[pkg_date_index[0], 'total_day_pkgs'] = total_pkgs
+    # insert the new column into dataframe
+    df.insert(loc=len(df.columns), column='total_day_pkgs', value=total_count_array)
             
     return df
     
     
     
+    
 
 def add_weather(df_master, df_weather):
-    # get a copy of the master dataframe
-    df = df_master.copy()
+    # get a copy of the master dataframe, columns are only added so they are shared
+    df = df_master.copy(deep=False)
     
-    # make arrays for the new columns
-    precip_array = np.full((len(df)), 0.0, dtype='float')
-    snow_array = np.full((len(df)), 0.0, dtype='float')
-    temp_array = np.full((len(df)), 0, dtype='int')
-    fog_array = np.full((len(df)), 0, dtype='int')
+    # the weather of every date, keyed by the integer dates
+    weather = df_weather.drop_duplicates(subset=['date'], keep='first').set_index('date')
     
-    # insert the new blank columns
-    df.insert(loc=len(df.columns), column='precip', value=precip_array)
-    df.insert(loc=len(df.columns), column='snow', value=snow_array)
-    df.insert(loc=len(df.columns), column='temp', value=temp_array)
-    df.insert(loc=len(df.columns), column='fog', value=fog_array)
+    # every date needs weather data
+    missing = ~df['date'].isin(weather.index).to_numpy()
+    if missing.any():
+        raise KeyError('No weather data for date ' + str(df['date'].to_numpy()[missing][0]))
     
-    # get the unique package IDs
-    master_idx = pd.unique(df['package_id'])
+    # the first entry of every package's date gets the weather
+    first = ~df.duplicated(subset=['package_id', 'date'], keep='first').to_numpy()
     
-    # loop over all the packages
-    for i in tqdm(master_idx):
-        # get the package's history
-        pkg = df[df['package_id'] == i]
-        
-        # get the unique dates
-        dates = pd.unique(pkg['date'])
-        
-        for d in dates:
-            # get the weather for date in a series
-            weather = df_weather[df_weather['date'] == d]
-            
-            # sequeeze df row into a series
-            weather.squeeze()
-            
-            # get indices for package's date
-            pkg_date_index = pkg[pkg['date'] == d].index
-            
-            # set the weather values
-            df.at[pkg_date_index[0], 'precip'] = weather['precip'].values[0]
-            df.at[pkg_date_index[0], 'snow'] = weather['snow'].values[0]
-            df.at[pkg_date_index[0], 'temp'] = weather['temp'].values[0]
-            df.at[pkg_date_index[0], 'fog'] = weather['fog'].values[0]
+    # join the weather columns and insert them
+    for column, dtype in [('precip', 'float'), ('snow', 'float'), ('temp', 'int'), ('fog', 'int')]:
+        values = df['date'].map(weather[column]).to_numpy()
+        array = np.where(first, values, 0).astype(dtype)
+        df.insert(loc=len(df.columns), column=column, value=array)
             
     return df
     
@@ -299,33 +275,107 @@ def finalizer(df_master):
 
 
 
-def main():
+def restore_package_ids(df_master, package_ids):
+    # make a copy of the master dataframe
+    df = df_master.copy()
+    
+    # replace the package surrogates with the original package IDs
+    package_ids = np.asarray(package_ids, dtype='object')
+    df['package_id'] = package_ids[df['package_id'].to_numpy()]
+    
+    return df
+
+
+
+
+def date_argument(args, flag):
+    # a yyyymmdd date given after the flag, None if the flag is not given
+    date = None
+    if flag in args:
+        index = args.index(flag)
+        try:
+            date = int(args[index+1])
+        except (IndexError, ValueError):
+            print("A yyyymmdd date is needed after " + flag + ".")
+            print(__doc__)
+            input("Press enter to continue...")
+            sys.exit()
+            
+    return date
+
+
+
+
+def main(args):
+    # print the usage
+    if '--help' in args:
+        print(__doc__)
+        sys.exit()
+        
+    # only merge the packages with events in a date window: --start yyyymmdd --end yyyymmdd
+    start = date_argument(args, '--start')
+    end = date_argument(args, '--end')
+    
     # check if path for weather data exists
     path = 'compiled/'
     if not os.path.exists(path):
         os.makedirs(path)
         print("No compiled dataframe directory found.")
-        print("Place pickled dataframes in \'compiled\'.")
+        print("The compiled dataframes are saved in \'compiled\' as column stores (.columns) or date partitions (.parts).")
         print("You may need to compile your dataframes first with preprocessor.py.")
         input("Press enter to continue...")
         sys.exit()
     
-    # file names to look for
-    file_aggregate = 'df_aggregate.pkl'
-    file_merged_history = 'df_merged_history.pkl'
-    file_package = 'df_package.pkl'
+    # file names to look for, the compiled dataframes without their extension
+    file_aggregate = 'df_aggregate'
+    file_merged_history = 'df_merged_history'
+    file_package = 'df_package'
     file_weather = 'df_weather.pkl'
+    file_package_ids = 'package_ids.pkl'
     
-    # load the data if it exists
+    # only the columns used for the master dataframe
+    columns_aggregate = ['date', 'pkg_counts']
+    columns_history = ['package_id', 'status', 'date', 'zipcode', 'provider', 'assigned_area', \
+                       'station_code', 'driver_code', 'reason']
+    
+    # load the data if it exists, the column stores are opened read-only without reading them
     try:
-        df_aggregate = pd.read_pickle(path + file_aggregate)
-        df_history = pd.read_pickle(path + file_merged_history)
-        df_package = pd.read_pickle(path + file_package)
+        # the packages with an event in the date window, a date partitioned
+        # history only reads the partitions of the window to find them
+        window = start is not None or end is not None
+        if window:
+            window_ids = read_dataframe(path + file_merged_history, ['package_id'], start=start, end=end)
+            window_ids = pd.unique(window_ids['package_id'])
+        
+        # the whole history of those packages, labels need the events outside of the window too
+        df_history = read_dataframe(path + file_merged_history, columns_history)
+        if window:
+            df_history = df_history[df_history['package_id'].isin(window_ids).to_numpy()]
+        df_history = apply_schema(df_history, 'merged')
+        df_package = apply_schema(read_dataframe(path + file_package), 'package')
+        package_ids = pd.read_pickle(path + file_package_ids)
+        
+        # only the aggregate and weather data of the history's dates are needed
+        if len(df_history) > 0:
+            start, end = int(df_history['date'].min()), int(df_history['date'].max())
+        df_aggregate = apply_schema(read_dataframe(path + file_aggregate, columns_aggregate, start=start, end=end), 'aggregate')
         df_weather = pd.read_pickle(path + file_weather)
         
+        # weather data saved by an older run has yyyymmdd strings as dates
+        if not pd.api.types.is_integer_dtype(df_weather['date']):
+            df_weather['date'] = df_weather['date'].astype('int64').astype(DATE_DTYPE)
+        df_weather = date_rows(df_weather, start, end)
+        
     except:
         print("No data found.")
-        print("Place pickled dataframes in \'compiled\'.")
+        print("Build, merge and clean the dataframes with preprocessor.py, they are saved in \'compiled\'.")
+        print("The weather data (df_weather.pkl) is made by preprocessor-weather.py.")
+        input("Press enter to continue...")
+        sys.exit()
+        
+    # a date window can hold no packages
+    if len(df_history) == 0:
+        print("No packages with events in the dates given.")
         input("Press enter to continue...")
         sys.exit()
     
@@ -339,7 +389,7 @@ def main():
     
     # initialize master dataframe
     print("Adding package history data...")
-    df_master = df_history.copy()
+    df_master = df_history.copy(deep=False)
     print("Done.", end='\n\n')  
     
     # add aggregate data
@@ -367,12 +417,18 @@ def main():
     df_master = finalizer(df_master)
     print("Done.", end='\n\n')
     
+    # the original package IDs are only needed in the output
+    print("Restoring package IDs...")
+    df_master = restore_package_ids(df_master, package_ids)
+    df_master = apply_schema(df_master, 'master')
+    print("Done.", end='\n\n')
+    
     # check save path
     if not os.path.exists(path):
         os.makedirs(path)
       
     # save the master dataframe
-    df_master.to_pickle(path + 'df_master.pkl')
+    write_dataframe(df_master, path + 'df_master')
     df_master.to_csv(path + 'package_data.csv', index=False)
     
     # print success on completion
@@ -382,11 +438,11 @@ def main():
     print("----------------------------------")
     print("---------MERGER SUCCESS-----------")
     print("----------------------------------")
-    print("Dataframe saved as a csv and pickle file in:", path)
+    print("Dataframe saved as a csv file and a column store in:", path)
     input("Press enter to end...")
 
 
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(sys.argv)
\ No newline at end of file
@@ -3,7 +3,7 @@ Preprocessor
 
 Description:
 Script for preprocessing and cleaning package data. Store
-the preprocessed data into a pickle file for mining operations.
+the preprocessed data as column stores for mining operations.
 """
 
 # data libraries
@@ -16,7 +16,15 @@ import os
 import datetime
 import pickle
 import time
-from collections import defaultdict
+import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# peak memory of the cleaning audit (not available on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # progress bar
 from tqdm import tqdm
@@ -25,6 +33,13 @@ from tqdm import tqdm
 from consolemenu import *
 from consolemenu.items import *
 
+# compact column types of the compiled dataframes
+from schema import DATE_DTYPE, ID_DTYPE, apply_schema
+
+# memory-mapped column stores for the compiled dataframes, pyarrow for the parse cache
+from storage import COLUMNAR, atomic_write, write_dataframe, read_dataframe, remove_dataframe, \
+                    dataframe_format, dataframe_partitions, frame_fingerprint
+
 # warning handling
 import warnings
 
@@ -38,8 +53,58 @@ SCRIPT_PATH = "logs/"               # path for error logs and such
 FILES = []                          # File list
 START = datetime.date(2000, 1, 1)   # Start date in date range
 END = datetime.date(2000, 1, 1)     # End date in date range
-DATAFRAMES = [[], [], [], [], []]   # dataframes [df_aggregate, df_package, df_history]
-ERROR_LOGS = [[], [], []]           # Error logs [build_errors, merge_errors, clean_errors]
+DATAFRAMES = [[], [], [], [], []]   # dataframes [df_aggregate, df_package, df_history, df_pld, df_merged]
+DIRTY = [False, False, False, False, False]     # dataframes changed since they were last loaded or stored
+ERROR_LOGS = [[], [], []]           # Error logs [build_errors, merge_errors, clean_audit]
+WORKERS = os.cpu_count() or 1       # Number of processes for a parallel build
+PARSE_CACHE_VERSION = 2             # Bump when parsing changes to invalidate cached workbooks
+CHECKPOINT_VERSION = 1              # Bump when cleaning changes to invalidate clean checkpoints
+PARTITIONS = None                   # Date partitions of the history files: 'day', 'month', 'none' (None keeps the saved layout)
+CODE_LETTERS = re.compile('[a-zA-Z]')   # letters removed from station and driver codes
+PACKAGE_IDS = {}                    # Package ID dictionary <package ID : int32 surrogate>
+
+# dataframe type and file of every slot in DATAFRAMES
+DATAFRAME_TYPES = ['aggregate', 'package', 'history', 'pld', 'merged']
+DATAFRAME_FILES = ['df_aggregate', 'df_package', 'df_history', 'df_pld', 'df_merged_history']
+PARTITIONED_TYPES = ['history', 'pld', 'merged']     # dataframes that can be saved in date partitions
+
+# sheets read from every daily workbook in build order <sheet : dataframe name in error log>
+WORKBOOK_SHEETS = {'Daily' : 'df_aggregate (Daily)', 'SVC' : 'df_package (SVC)', \
+                   '85_SVC' : 'df_package (85_SVC)', 'HIST' : 'df_history (HIST)', \
+                   '85_HIST' : 'df_history (85_HIST)', 'PLD' : 'df_pld (PLD)', '85' : 'df_pld (85)'}
+
+# delivery area zip codes of every provider <provider : zip codes>
+ZIP_DICT = { \
+    'H': [65604, 65605, 65612, 65613, 65617, 65635, 65645, 65646, 65661, \
+          65663, 65664, 65674, 65682, 65707, 65710, 65712, 65721, 65725, \
+          65727, 65752, 65769, 65770, 65767, 65803, 65804], \
+    'B': [65590, 65622, 65632, 65644, 65648, 65685, 65706, 65713, 65722, \
+          65757, 65764, 65783, 65786, 65787, 65667, 65662, 65767], \
+    'C': [65608, 65614, 65618, 65620, 65627, 65629, 65637, 65638, 65653, \
+          65655, 65657, 65666, 65676, 65679, 65680, 65701, 65715, 65720, \
+          65729, 65731, 65733, 65741, 65744, 65753, 65755, 65759, 65760, \
+          65761, 65762, 65768], \
+    'F': [65610, 65631, 65705, 65738, 65781, 65633, 65619, 65802, 65803, 65807], \
+    'A': [65611, 65615, 65616, 65624, 65630, 65641, 65656, 65658, 65669, \
+          65672, 65675, 65681, 65686, 65726, 65728, 65737, 65739, 65740, \
+          65747, 65754, 65771], \
+    'K': [65609, 65626, 65660, 65689, 65766, 65775, 65776, 65777, 65788, \
+          65789, 65790, 65793], \
+    'D': [64738, 64776, 65324, 65326, 65355, 65601, 65603, 65634, 65640, \
+          65649, 65650, 65668, 65724, 65732, 65735, 65774, 65779, 65785, \
+          64781, 65607], \
+    'G': [65742, 65765, 65809, 65802, 65807, 65804], \
+    'J': [65714, 65801, 65806, 65808, 65810, 65897, 65898, 65899, 65619, \
+          65802, 65803, 65804, 65807], \
+    'E': [65636, 65652, 65702, 65704, 65711, 65717, 65746]}
+
+# Recodes List <recoded code : station and driver codes>
+RECODE_DICT = {1: {1, 4, 7, 11, 36, 57, 59, 82, 83}, 2: {15, 34, 47, 94, 100}, 3: {40, 300},
+               4: {33, 35, 42, 43, 51, 52, 53, 54, 56, 63, 67, 68}, 5: {12, 16, 27, 37},
+               6: {2, 3, 17}, 7: {85}, 8: {6, 81}, 9: {10}}
+
+# Sub recodes List <recoded reason : reason code>, only used for driver code 2
+SUB_RECODE_DICT = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 73, 7: 74}
 
 # ignore warnings
 warnings.filterwarnings('ignore')
@@ -98,8 +163,9 @@ def capture_filenames():
     
     
     # if the data path exists, try and get the filenames
+    # sorted so the file list is in file date order (PACKAGE_yyyymmdd)
     try:
-        for file in os.listdir(data_path):
+        for file in sorted(os.listdir(data_path)):
             name = os.path.join(data_path, file)
             
             if os.path.isfile(name):
@@ -110,6 +176,41 @@ def capture_filenames():
 
 
 
+def load_dataframe(df_type, columns=None, start=None, end=None):
+    """
+    load_dataframe(df_type, columns=None, start=None, end=None) -> df (dataframe)
+    
+    args:
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld' or 'merged'
+    columns (list) -> columns to load, all the columns if None
+    start (int) -> first yyyymmdd date to load, None for no lower limit
+    end (int) -> last yyyymmdd date to load, None for no upper limit
+    
+    returns:
+    df (dataframe) -> the loaded dataframe, an empty list if there is no file
+    
+    Desc:
+    Load one dataframe from its file. Column stores are memory-mapped, so
+    only the columns that are used get read, and their changes stay in
+    memory. With a date range only its rows are loaded, and dataframes saved
+    in date partitions only read the partitions in the range. String dates
+    and package IDs saved by older builds are converted to yyyymmdd integers
+    and surrogates, and the dataframe is cast to its compact schema.
+    """
+    # get the file of the dataframe
+    path = os.path.join(get_path('output'), DATAFRAME_FILES[DATAFRAME_TYPES.index(df_type)])
+    
+    # an empty list stands for a dataframe that is not built
+    df = []
+    if dataframe_format(path) is not None:
+        df = int_package_ids(int_dates(read_dataframe(path, columns, True, start, end)))
+        df = apply_schema(df, df_type)
+        
+    return df
+    
+    
+    
+    
 def load_dataframes():   
     """
     load_dataframes() -> success (bool)
@@ -121,59 +222,39 @@ def load_dataframes():
     success (bool) -> if operation was successful
     
     Desc:
-    Load the dataframes from the pickle files.
+    Load all the dataframes from their files with load_dataframe. Feather
+    files and pickles from older builds, and dataframes saved in another
+    layout than the one asked for, stay dirty so they are stored again.
     """
-    # get the output path
-    output_path = get_path('output')
-    
     # if file load is successful or not
     success = True
     
-    # get aggregate dataframe
-    path = os.path.join(output_path, 'df_aggregate.pkl')
-    if os.path.isfile(path):
-        df = pd.read_pickle(path)
-        set_dataframe(df, 'aggregate')
-    else:
-        success = False
+    # get the package ID dictionary first, older dataframes get interned into it
+    load_package_ids()
     
-    # get package dataframe
-    path = os.path.join(output_path, 'df_package.pkl')
-    if os.path.isfile(path):
-        df = pd.read_pickle(path)
-        set_dataframe(df, 'package')
-    else:
-        success = False
+    # without a layout asked for, keep the date partitions of the saved history
+    if get_partitions() is None:
+        path = os.path.join(get_path('output'), DATAFRAME_FILES[DATAFRAME_TYPES.index('history')])
+        set_partitions(dataframe_partitions(path) or 'none')
     
-    # get history dataframe
-    path = os.path.join(output_path, 'df_history.pkl')
-    if os.path.isfile(path):
-        df = pd.read_pickle(path)
-        set_dataframe(df, 'history')
-    else:
-        success = False
-        
-    # get pld dataframe
-    path = os.path.join(output_path, 'df_pld.pkl')
-    if os.path.isfile(path):
-        df = pd.read_pickle(path)
-        set_dataframe(df, 'pld')
-    else:
-        success = False
-        
-    # get merged dataframe
-    path = os.path.join(output_path, 'df_merged_history.pkl')
-    if os.path.isfile(path):
-        df = pd.read_pickle(path)
-        set_dataframe(df, 'merged')
+    # get every dataframe, the merged history is not needed for success
+    for df_type in DATAFRAME_TYPES:
+        df = load_dataframe(df_type)
+        if isinstance(df, list) and df_type != 'merged':
+            success = False
+            
+        # the loaded dataframes are the same as their files
+        set_dataframe(df, df_type)
+        path = os.path.join(get_path('output'), DATAFRAME_FILES[DATAFRAME_TYPES.index(df_type)])
+        layout = dataframe_layout(df_type)
+        if (layout is None and dataframe_format(path) == 'columns') or \
+           (layout is not None and dataframe_partitions(path) == layout):
+            set_dataframe_clean(df_type)
         
     # set empty if no success in getting dataframes
     if success == False:
-        set_dataframe([], 'aggregate')
-        set_dataframe([], 'package')
-        set_dataframe([], 'history')
-        set_dataframe([], 'pld')
-        set_dataframe([], 'merged')
+        for df_type in DATAFRAME_TYPES:
+            set_dataframe([], df_type)
         
     return success
     
@@ -191,7 +272,10 @@ def store_dataframes():
     success (bool) -> if operation was successful
     
     Desc:
-    Store the loaded dataframes into a pickle file.
+    Store the dataframes changed since they were loaded or stored, as
+    column stores when possible. The history dataframes are saved in date
+    partitions if asked for, then only the changed partitions are written.
+    A dataframe is only switched to its new files once they are all written.
     """
     # get the output path
     output_path = get_path('output')
@@ -201,49 +285,27 @@ def store_dataframes():
     
     
     if os.path.exists(output_path):
-        # save aggregate
-        try:
-            path = os.path.join(output_path, 'df_aggregate.pkl')
-            df = get_dataframe('aggregate')
-            df.to_pickle(path)            
-            success = True
-        except:
-            success = False
-         
-        # save package
-        try:    
-            path = os.path.join(output_path, 'df_package.pkl')
-            df = get_dataframe('package')
-            df.to_pickle(path)
-            success = True
-        except:
-            success = False
-        
-        # save history
-        try:
-            path = os.path.join(output_path, 'df_history.pkl')
-            df = get_dataframe('history')
-            df.to_pickle(path)
-            success = True
-        except:
-            success = False
+        success = True
         
-        # save pld
-        try:
-            path = os.path.join(output_path, 'df_pld.pkl')
-            df = get_dataframe('pld')
-            df.to_pickle(path)
-            success = True
-        except:
-            success = False
+        # if any dataframe was written, new package IDs come with them
+        written = False
         
-        # save merged history
-        try:
-            path = os.path.join(output_path, 'df_merged_history.pkl')
-            df = get_dataframe('merged')
-            df.to_pickle(path)
-        except:
-            print('')
+        for df_type, filename in zip(DATAFRAME_TYPES, DATAFRAME_FILES):
+            # clean dataframes are the same as their files
+            if not dataframe_dirty(df_type):
+                continue
+                
+            try:
+                path = os.path.join(output_path, filename)
+                write_dataframe(get_dataframe(df_type), path, dataframe_layout(df_type))
+                set_dataframe_clean(df_type)
+                written = True
+            except Exception:
+                success = False
+            
+        # save the package ID dictionary
+        if written or not os.path.isfile(os.path.join(output_path, 'package_ids.pkl')):
+            store_package_ids()
         
     return success
     
@@ -285,6 +347,14 @@ def load_error_logs():
             log = pickle.load(handle)
             set_error_log(log, 'merge')
             success = True
+            
+    # load the audit of the last cleaning and set to our global error log list, if it exists
+    path = os.path.join(script_path, 'clean_audit.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as handle:
+            log = pickle.load(handle)
+            set_error_log(log, 'clean')
+            success = True
         
     return success
     
@@ -309,6 +379,7 @@ def store_error_logs():
     # get our error logs
     build_log = get_error_log('build')
     merge_log = get_error_log('merge')
+    clean_log = get_error_log('clean')
     
     # if save is successful or not
     success = True
@@ -327,194 +398,740 @@ def store_error_logs():
             with open(path, 'wb') as handle:               
                 pickle.dump(merge_log, handle)
                 
+        # if there is a cleaning audit, save it to our script directory
+        path = os.path.join(script_path, 'clean_audit.pkl')
+        if len(clean_log) != 0:
+            with open(path, 'wb') as handle:
+                pickle.dump(clean_log, handle)
+                
     else:
         success = False
         
     return success
-# -------------------------------------------------------------------------------------------------------->
-# ---------------------------------------------- END FILE FUNCTIONS -------------------------------------->
-# -------------------------------------------------------------------------------------------------------->
 
 
 
-# -------------------------------------------------------------------------------------------------------->
-# ---------------------------------------------- MENU FUNTION -------------------------------------------->
-# -------------------------------------------------------------------------------------------------------->
-def menu(start_string, end_string):
+
+def load_package_ids():
     """
-    menu() -> None
+    load_package_ids() -> success (bool)
     
     args:
-    start_string (str) -> file starting date
-    end_string (str) -> file ending date
+    None
     
     returns:
-    None
+    success (bool) -> if operation was successful
     
     Desc:
-    The script main menu.
+    Load the package ID dictionary of the compiled dataframes. The file
+    holds the original package IDs in the order of their surrogates.
     """
-    # main menu creation
-    main_menu = ConsoleMenu("Preprocessor", start_string + '\n' + end_string)
-    
-    # menu options
-    option_build  = FunctionItem("Build Dataframes", build_data, [])
-    option_merge  = FunctionItem("Merge Dataframes", history_merge_pld, [])
-    option_clean  = FunctionItem("Clean Dataframes", clean_data, [])
-    option_dates  = FunctionItem("Display All File Dates", display_dates, [])
-    option_errors = FunctionItem("Show Errors", display_errors, [])
-    option_show   = FunctionItem("Show Built Dataframes", display_dataframes, [])
+    # get the output path
+    path = os.path.join(get_path('output'), 'package_ids.pkl')
     
-    # add options to the menu
-    main_menu.append_item(option_build)
-    main_menu.append_item(option_merge)
-    main_menu.append_item(option_clean)
-    main_menu.append_item(option_dates)
-    main_menu.append_item(option_errors)
-    main_menu.append_item(option_show)
+    # if file load is successful or not
+    success = False
     
-    main_menu.show()
-# -------------------------------------------------------------------------------------------------------->
-# ---------------------------------------------- END MENU FUNTION ---------------------------------------->
-# -------------------------------------------------------------------------------------------------------->
+    ids = {}
+    if os.path.isfile(path):
+        with open(path, 'rb') as handle:
+            ids = {i : n for n, i in enumerate(pickle.load(handle))}
+        success = True
+        
+    set_package_ids(ids)
+            
+    return success
 
 
 
 
-# -------------------------------------------------------------------------------------------------------->
-# -------------------------------------------------- HELPER FUNCTIONS ------------------------------------>
-# -------------------------------------------------------------------------------------------------------->
-def capture_file_date(filename):
-    # set default date
-    date = datetime.date(2000, 1, 1)
+def store_package_ids():
+    """
+    store_package_ids() -> success (bool)
     
-    # try to obtain the date from the filename
-    try:
-        date = str_to_date(filename[13:21])
-    except:
-        print("\n")
-        print("An error with getting the date for " + filename + " has occurred.")
-        print("Proper filename format needed: PACKAGE_yyyymmdd")
-        print("\n")
+    args:
+    None
     
-    return date
+    returns:
+    success (bool) -> if operation was successful
+    
+    Desc:
+    Store the package ID dictionary next to the compiled dataframes.
+    """
+    # get the output path
+    output_path = get_path('output')
+    
+    # if save is successful or not
+    success = False
+    
+    if os.path.exists(output_path):
+        path = os.path.join(output_path, 'package_ids.pkl')
+        atomic_write(path, lambda handle: pickle.dump(list(get_package_ids()), handle))
+        success = True
+        
+    return success
 
 
 
 
-def str_to_date(str_date):
-    # convert string date into date object
-    date = datetime.date(int(str_date[0:4]), int(str_date[4:6]), int(str_date[6:8]))
-    return date
+def load_ingest_manifest():
+    """
+    load_ingest_manifest() -> manifest (dict)
     
+    args:
+    None
     
+    returns:
+    manifest (dict) -> 'files' built into the dataframes, 'packages_85' and
+                       'history_85' package IDs only found in '85' sheets,
+                       None if there is no manifest
     
+    Desc:
+    Load the manifest of files that have been ingested into the compiled dataframes.
+    """
+    # get the output path
+    path = os.path.join(get_path('output'), 'ingest_manifest.pkl')
     
-def date_to_str(date):
-    # convert date into a string
-    str_date = date.strftime('%Y%m%d')
-    return str_date
-# -------------------------------------------------------------------------------------------------------->
-# ---------------------------------------------- END HELPER FUNCTIONS ------------------------------------>
-# -------------------------------------------------------------------------------------------------------->
+    # no manifest if the dataframes were never built
+    manifest = None
+    if os.path.isfile(path):
+        with open(path, 'rb') as handle:
+            manifest = pickle.load(handle)
+            
+        # package IDs from builds before the surrogates are interned
+        for key in ['packages_85', 'history_85']:
+            ids = pd.Series(list(manifest[key]), dtype='object')
+            if not pd.api.types.is_integer_dtype(ids.infer_objects()):
+                manifest[key] = set(intern_package_ids(ids))
+            
+    return manifest
 
 
 
 
-# -------------------------------------------------------------------------------------------------------->
-# -------------------------------------------- USER DISPLAY FUNCTIONS ------------------------------------>
-# -------------------------------------------------------------------------------------------------------->
-def display_errors():
-    # get the error logs
-    build_log = get_error_log('build')
-    merge_log = get_error_log('merge')
+def store_ingest_manifest(manifest):
+    """
+    store_ingest_manifest(manifest) -> success (bool)
     
-    if len(build_log) != 0 or len(merge_log) != 0:
-        # ask the user which errors to see
-        print("Which errors would you like to see?")
-        print("Options: B = Build, M = Merge")
-        print("\n")
-        option = input(">: ")
-        
-        # get the errors for the build data
-        if option.upper() == 'B':
-            if len(build_log) != 0:
-                
-                error_index = 1
-                # print the error report for data building
-                for i in build_log:
-                    print("\n")
-                    print("Error #", error_index)
-                    print("Error while building data for:", i[0])
-                    print("Error from file:", i[1])
-                    print(type(i[2]), ':', i[2])
-                    print('\n')
-                    
-                    error_index += 1
-                    
-                print("Build errors found:", len(build_log))
-                print("This data was not built properly!", end='\n\n')
-            else:
-                print("No build errors to display.", end='\n\n')
-                
-        # get the errors for the  merge data    
-        elif option.upper() == 'M':
-            if len(merge_log) != 0:
-                error_index = 1
-                # print error report for data merging
-                for i in merge_log:
-                    print('\n')
-                    print("Error #", error_index)
-                    print('Error with package:', i[0])
-                    print('Merging PLD date:', i[1])
-                    print(type(i[2]), ':', i[2])
-                    print('\n')
-                    
-                    error_index += 1
-                
-                print("Merge errors found:", len(merge_log))
-                print("This data was not merged properly!", end='\n\n')
-            else:
-                print("No merge errors to display.", end='\n\n')
-                
-        else:
-            print('\n')
-            print("Invalid selection.", end='\n\n')
-    else:
-        print("No error to display.", end='\n\n')
-        
-    # Wait until the user clears screen
-    input("Press enter to continue...")
+    args:
+    manifest (dict) -> 'files', 'packages_85' and 'history_85'
     
+    returns:
+    success (bool) -> if operation was successful
     
+    Desc:
+    Store the manifest of files that have been ingested into the compiled dataframes.
+    """
+    # get the output path
+    output_path = get_path('output')
     
-
-def display_dataframes():
-    # get the dataframes
-    df_aggregate = get_dataframe('aggregate')
-    df_package = get_dataframe('package')
-    df_history = get_dataframe('history')
-    df_pld = get_dataframe('pld')
-    df_merged = get_dataframe('merged')
+    # if save is successful or not
+    success = False
     
-    # display dataframes if there are any built
-    if len(df_aggregate) != 0 or len(df_package) != 0 or len(df_history) != 0:
-        # display the dataframes on the console
-        print("Dataframe Aggregate:\n", df_aggregate, end='\n\n')
-        print("Dataframe Package:\n", df_package, end='\n\n')
-        print("Dataframe History:\n", df_history, end='\n\n')
-        print("Dataframe PLD:\n", df_pld, end='\n\n')
-        print("Dataframe Merged History:\n", df_merged, end='\n\n')
-    else:
-        print("No dataframes to display.", end='\n\n')
+    if os.path.exists(output_path):
+        path = os.path.join(output_path, 'ingest_manifest.pkl')
+        atomic_write(path, lambda handle: pickle.dump(manifest, handle))
+        success = True
+        
+    return success
 
-    # Wait until the user clears screen
-    input("Press enter to continue...")
+
+
+
+def load_cache_index():
+    """
+    load_cache_index() -> cache_index (dict)
     
+    args:
+    None
     
+    returns:
+    cache_index (dict) -> filename : [size, mtime, content hash]
     
+    Desc:
+    Load the index of hashed workbooks from the parse cache.
+    """
+    # get the parse cache directory
+    path = os.path.join(get_path('output'), 'parse_cache', 'index.pkl')
     
-def display_dates():
+    # empty index if there is none or it can't be read
+    cache_index = {}
+    if os.path.isfile(path):
+        try:
+            with open(path, 'rb') as handle:
+                cache_index = pickle.load(handle)
+        except Exception:
+            cache_index = {}
+            
+    return cache_index
+
+
+
+
+def store_cache_index(cache_index):
+    """
+    store_cache_index(cache_index) -> success (bool)
+    
+    args:
+    cache_index (dict) -> filename : [size, mtime, content hash]
+    
+    returns:
+    success (bool) -> if operation was successful
+    
+    Desc:
+    Store the index of hashed workbooks in the parse cache.
+    """
+    # get the parse cache directory
+    cache_path = os.path.join(get_path('output'), 'parse_cache')
+    
+    # if save is successful or not
+    success = True
+    
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        with open(os.path.join(cache_path, 'index.pkl'), 'wb') as handle:
+            pickle.dump(cache_index, handle)
+    except Exception:
+        success = False
+        
+    return success
+
+
+
+
+def workbook_cache_key(file, cache_index):
+    """
+    workbook_cache_key(file, cache_index) -> key (string)
+    
+    args:
+    file (string) -> workbook filename
+    cache_index (dict) -> filename : [size, mtime, content hash]
+    
+    returns:
+    key (string) -> hash of the workbook contents, its file date and the cache version
+    
+    Desc:
+    Get the key of a workbook in the parse cache. The parsed fragments hold
+    the date from the filename, so the same workbook under another date
+    gets another key. The file is only hashed again when its size or
+    modified time differ from the cache index.
+    """
+    # size and modified time of the file
+    stat = os.stat(file)
+    
+    # reuse the hash if the file has not changed
+    entry = cache_index.get(file)
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+        content = entry[2]
+    else:
+        # hash the file contents
+        sha = hashlib.sha256()
+        with open(file, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                sha.update(block)
+        content = sha.hexdigest()
+        
+        # update the index
+        cache_index[file] = [stat.st_size, stat.st_mtime_ns, content]
+    
+    # the file date and the parsing version are part of the parsed fragments
+    key = content + ':' + str(capture_file_date(file)) + ':' + str(PARSE_CACHE_VERSION)
+    
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+
+
+def load_cached_workbook(key):
+    """
+    load_cached_workbook(key) -> fragments (dict)
+    
+    args:
+    key (string) -> content hash of the workbook
+    
+    returns:
+    fragments (dict) -> sheet name : dataframe, None if not in the cache
+    
+    Desc:
+    Load the parsed sheets of a workbook from the parse cache.
+    """
+    # the workbook's directory in the parse cache
+    entry_path = os.path.join(get_path('output'), 'parse_cache', key)
+    manifest_path = os.path.join(entry_path, 'manifest.pkl')
+    
+    # the manifest is written last, no manifest means no complete entry
+    if not os.path.isfile(manifest_path):
+        return None
+    
+    try:
+        with open(manifest_path, 'rb') as handle:
+            manifest = pickle.load(handle)
+            
+        # entries from older parsing code are stale
+        if manifest['version'] != PARSE_CACHE_VERSION:
+            return None
+        
+        # read every sheet in the format it was stored
+        fragments = {}
+        for sheet, file_format in manifest['sheets'].items():
+            path = os.path.join(entry_path, sheet)
+            if file_format == 'parquet':
+                fragments[sheet] = pd.read_parquet(path + '.parquet')
+            elif file_format == 'pickle':
+                fragments[sheet] = pd.read_pickle(path + '.pkl')
+            else:
+                fragments[sheet] = None
+    except Exception:
+        fragments = None
+        
+    return fragments
+
+
+
+
+def store_cached_workbook(key, fragments):
+    """
+    store_cached_workbook(key, fragments) -> success (bool)
+    
+    args:
+    key (string) -> content hash of the workbook
+    fragments (dict) -> sheet name : dataframe
+    
+    returns:
+    success (bool) -> if operation was successful
+    
+    Desc:
+    Store the parsed sheets of a workbook in the parse cache. Sheets are
+    written as parquet files when possible, otherwise they are pickled.
+    """
+    # the workbook's directory in the parse cache
+    entry_path = os.path.join(get_path('output'), 'parse_cache', key)
+    
+    # if save is successful or not
+    success = True
+    
+    try:
+        os.makedirs(entry_path, exist_ok=True)
+        
+        # sheet name : file format
+        sheets = {}
+        for sheet, df in fragments.items():
+            path = os.path.join(entry_path, sheet)
+            sheets[sheet] = None
+            
+            if df is None:
+                continue
+            
+            # columnar file first, columns with mixed types can't be stored in one
+            if COLUMNAR:
+                try:
+                    df.to_parquet(path + '.parquet')
+                    sheets[sheet] = 'parquet'
+                except Exception:
+                    sheets[sheet] = None
+                    
+            if sheets[sheet] is None:
+                df.to_pickle(path + '.pkl')
+                sheets[sheet] = 'pickle'
+        
+        # write the manifest last to mark the entry complete
+        manifest = {'version' : PARSE_CACHE_VERSION, 'sheets' : sheets}
+        with open(os.path.join(entry_path, 'manifest.pkl'), 'wb') as handle:
+            pickle.dump(manifest, handle)
+    except Exception:
+        success = False
+        
+    return success
+
+
+
+
+def load_checkpoint(stage, key):
+    """
+    load_checkpoint(stage, key) -> frames (tuple)
+    
+    args:
+    stage (string) -> name of the cleaning stage
+    key (string) -> checkpoint key of the stage
+    
+    returns:
+    frames (tuple) -> (df_package, df_history) after the stage, None if
+                      there is no checkpoint for the key
+    
+    Desc:
+    Load the dataframes saved after a cleaning stage.
+    """
+    # the stage's directory in the checkpoints
+    entry_path = os.path.join(get_path('output'), 'checkpoints', stage)
+    manifest_path = os.path.join(entry_path, 'manifest.pkl')
+    
+    # the manifest is written last, no manifest means no complete checkpoint
+    if not os.path.isfile(manifest_path):
+        return None
+    
+    try:
+        with open(manifest_path, 'rb') as handle:
+            manifest = pickle.load(handle)
+            
+        # checkpoints of other inputs are stale
+        if manifest['key'] != key:
+            return None
+        
+        df_package = apply_schema(read_dataframe(os.path.join(entry_path, 'package'), writable=True), 'package')
+        df_history = apply_schema(read_dataframe(os.path.join(entry_path, 'history'), writable=True), 'merged')
+        frames = (df_package, df_history)
+    except Exception:
+        frames = None
+        
+    return frames
+
+
+
+
+def store_checkpoint(stage, key, df_package, df_history):
+    """
+    store_checkpoint(stage, key, df_package, df_history) -> success (bool)
+    
+    args:
+    stage (string) -> name of the cleaning stage
+    key (string) -> checkpoint key of the stage
+    df_package (dataframe) -> package dataframe after the stage
+    df_history (dataframe) -> history dataframe after the stage
+    
+    returns:
+    success (bool) -> if operation was successful
+    
+    Desc:
+    Save the dataframes after a cleaning stage. Every stage keeps only its
+    latest checkpoint.
+    """
+    # the stage's directory in the checkpoints
+    entry_path = os.path.join(get_path('output'), 'checkpoints', stage)
+    manifest_path = os.path.join(entry_path, 'manifest.pkl')
+    
+    # if save is successful or not
+    success = True
+    
+    try:
+        os.makedirs(entry_path, exist_ok=True)
+        
+        # the old checkpoint is incomplete as soon as its files get replaced
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+            
+        write_dataframe(df_package, os.path.join(entry_path, 'package'))
+        write_dataframe(df_history, os.path.join(entry_path, 'history'))
+        
+        # write the manifest last to mark the checkpoint complete
+        manifest = {'key' : key}
+        atomic_write(manifest_path, lambda handle: pickle.dump(manifest, handle))
+    except Exception:
+        success = False
+        
+    return success
+# -------------------------------------------------------------------------------------------------------->
+# ---------------------------------------------- END FILE FUNCTIONS -------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+# -------------------------------------------------------------------------------------------------------->
+# ---------------------------------------------- MENU FUNTION -------------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+def menu_dates():
+    # the menu header with the current date range, appending files can extend it
+    start_string = "Start Date: " + str(get_start_date())
+    end_string = "End Date: " + str(get_end_date())
+    
+    return start_string + '\n' + end_string
+    
+    
+    
+    
+def menu():
+    """
+    menu() -> None
+    
+    args:
+    None
+    
+    returns:
+    None
+    
+    Desc:
+    The script main menu. The date range in the header is read again
+    every time the menu is drawn.
+    """
+    # main menu creation
+    main_menu = ConsoleMenu("Preprocessor", menu_dates)
+    
+    # menu options
+    option_build  = FunctionItem("Build Dataframes", build_data, [])
+    option_pbuild = FunctionItem("Build Dataframes (Parallel)", build_data, [True])
+    option_append = FunctionItem("Append New Files", append_data, [])
+    option_merge  = FunctionItem("Merge Dataframes", history_merge_pld, [])
+    option_clean  = FunctionItem("Clean Dataframes", clean_data, [])
+    option_fclean = FunctionItem("Clean Dataframes (Fused)", clean_data, [True])
+    option_pclean = FunctionItem("Clean Dataframes (Parallel)", clean_data, [False, None, True, True])
+    option_rclean = FunctionItem("Clean Dataframes (Restart From Stage)", clean_from_stage, [])
+    option_dates  = FunctionItem("Display All File Dates", display_dates, [])
+    option_errors = FunctionItem("Show Errors", display_errors, [])
+    option_show   = FunctionItem("Show Built Dataframes", display_dataframes, [])
+    
+    # add options to the menu
+    main_menu.append_item(option_build)
+    main_menu.append_item(option_pbuild)
+    main_menu.append_item(option_append)
+    main_menu.append_item(option_merge)
+    main_menu.append_item(option_clean)
+    main_menu.append_item(option_fclean)
+    main_menu.append_item(option_pclean)
+    main_menu.append_item(option_rclean)
+    main_menu.append_item(option_dates)
+    main_menu.append_item(option_errors)
+    main_menu.append_item(option_show)
+    
+    main_menu.show()
+# -------------------------------------------------------------------------------------------------------->
+# ---------------------------------------------- END MENU FUNTION ---------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+
+# -------------------------------------------------------------------------------------------------------->
+# -------------------------------------------------- HELPER FUNCTIONS ------------------------------------>
+# -------------------------------------------------------------------------------------------------------->
+def capture_file_date(filename):
+    # set default date
+    date = datetime.date(2000, 1, 1)
+    
+    # try to obtain the date from the filename
+    try:
+        date = str_to_date(filename[13:21])
+    except:
+        print("\n")
+        print("An error with getting the date for " + filename + " has occurred.")
+        print("Proper filename format needed: PACKAGE_yyyymmdd")
+        print("\n")
+    
+    return date
+
+
+
+
+def update_date_range(files):
+    # get the dates of all the files
+    dates = [capture_file_date(f) for f in files]
+    
+    # set the start and end dates to the first and last file dates
+    if len(dates) != 0:
+        set_start_date(min(dates))
+        set_end_date(max(dates))
+    
+    
+    
+    
+def str_to_date(str_date):
+    # convert string date into date object
+    date = datetime.date(int(str_date[0:4]), int(str_date[4:6]), int(str_date[6:8]))
+    return date
+    
+    
+    
+    
+def date_to_str(date):
+    # convert date into a string
+    str_date = date.strftime('%Y%m%d')
+    return str_date
+    
+    
+    
+    
+def date_to_int(date):
+    # convert date into a yyyymmdd integer
+    int_date = date.year * 10000 + date.month * 100 + date.day
+    return int_date
+    
+    
+    
+    
+def int_package_ids(df):
+    # intern a string 'package_id' column from an older build into surrogates
+    if 'package_id' in df.columns and not pd.api.types.is_integer_dtype(df['package_id']):
+        df['package_id'] = intern_package_ids(df['package_id'])
+        
+    return df
+    
+    
+    
+    
+def int_dates(df):
+    # convert a yyyymmdd string 'date' column from an older build to integers
+    if 'date' in df.columns and not pd.api.types.is_integer_dtype(df['date']):
+        df['date'] = df['date'].astype('int64').astype(DATE_DTYPE)
+        
+    return df
+    
+    
+    
+    
+def dataframe_layout(df_type):
+    # the date partitions a dataframe is saved in, None for one file
+    period = get_partitions()
+    if df_type not in PARTITIONED_TYPES or period in [None, 'none']:
+        return None
+    
+    return period
+    
+    
+    
+    
+def stage_key(stage, input_key):
+    # the checkpoint key of a stage from its name and the key of its input
+    return hashlib.sha256((stage + ':' + input_key).encode()).hexdigest()
+    
+    
+    
+    
+def process_usage():
+    # CPU seconds of this process and of its finished child processes (parallel cleaning)
+    times = os.times()
+    cpu_time = times.user + times.system + times.children_user + times.children_system
+    
+    # peak resident memory in bytes of this process or its largest child, None without resource
+    peak_rss = None
+    if resource is not None:
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        
+        # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+        if sys.platform != 'darwin':
+            peak_rss *= 1024
+            
+    return cpu_time, peak_rss
+# -------------------------------------------------------------------------------------------------------->
+# ---------------------------------------------- END HELPER FUNCTIONS ------------------------------------>
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+
+# -------------------------------------------------------------------------------------------------------->
+# -------------------------------------------- USER DISPLAY FUNCTIONS ------------------------------------>
+# -------------------------------------------------------------------------------------------------------->
+def display_errors():
+    # get the error logs
+    build_log = get_error_log('build')
+    merge_log = get_error_log('merge')
+    clean_log = get_error_log('clean')
+    
+    if len(build_log) != 0 or len(merge_log) != 0 or len(clean_log) != 0:
+        # ask the user which errors to see
+        print("Which errors would you like to see?")
+        print("Options: B = Build, M = Merge, C = Clean audit")
+        print("\n")
+        option = input(">: ")
+        
+        # get the errors for the build data
+        if option.upper() == 'B':
+            if len(build_log) != 0:
+                
+                error_index = 1
+                # print the error report for data building
+                for i in build_log:
+                    print("\n")
+                    print("Error #", error_index)
+                    print("Error while building data for:", i[0])
+                    print("Error from file:", i[1])
+                    print(type(i[2]), ':', i[2])
+                    print('\n')
+                    
+                    error_index += 1
+                    
+                print("Build errors found:", len(build_log))
+                print("This data was not built properly!", end='\n\n')
+            else:
+                print("No build errors to display.", end='\n\n')
+                
+        # get the errors for the  merge data    
+        elif option.upper() == 'M':
+            if len(merge_log) != 0:
+                error_index = 1
+                # print error report for data merging
+                for i in merge_log:
+                    print('\n')
+                    print("Error #", error_index)
+                    print('Error with package:', i[0])
+                    print('Merging PLD date:', i[1])
+                    print(type(i[2]), ':', i[2])
+                    print('\n')
+                    
+                    error_index += 1
+                
+                print("Merge errors found:", len(merge_log))
+                print("This data was not merged properly!", end='\n\n')
+            else:
+                print("No merge errors to display.", end='\n\n')
+                
+        # get the audit of the last cleaning
+        elif option.upper() == 'C':
+            if len(clean_log) != 0:
+                print('\n')
+                print("{:<10}{:>12}{:>12}{:>10}{:>10}{:>10}{:>10}{:>10}".format( \
+                      'Stage', 'Rows in', 'Rows out', 'Pkgs in', 'Pkgs out', 'Wall s', 'CPU s', 'RSS MB'))
+                
+                # print one line for every stage that was run
+                for i in clean_log:
+                    rss = '-' if i['peak_rss_delta'] is None else '{:.1f}'.format(i['peak_rss_delta'] / 2**20)
+                    print("{:<10}{:>12}{:>12}{:>10}{:>10}{:>10.2f}{:>10.2f}{:>10}".format( \
+                          i['stage'], i['rows_in'], i['rows_out'], i['packages_in'], i['packages_out'], \
+                          i['wall_time'], i['cpu_time'], rss))
+                    
+                print('\n')
+                print("Cleaning stages audited:", len(clean_log))
+                print("RSS MB is how much a stage raised the peak memory of the cleaning.", end='\n\n')
+            else:
+                print("No cleaning audit to display.", end='\n\n')
+                
+        else:
+            print('\n')
+            print("Invalid selection.", end='\n\n')
+    else:
+        print("No error to display.", end='\n\n')
+        
+    # Wait until the user clears screen
+    input("Press enter to continue...")
+    
+    
+    
+
+def display_dataframes():
+    # get the dataframes
+    df_aggregate = get_dataframe('aggregate')
+    df_package = get_dataframe('package')
+    df_history = get_dataframe('history')
+    df_pld = get_dataframe('pld')
+    df_merged = get_dataframe('merged')
+    
+    # display dataframes if there are any built
+    if len(df_aggregate) != 0 or len(df_package) != 0 or len(df_history) != 0:
+        # display the dataframes on the console
+        print("Dataframe Aggregate:\n", df_aggregate, end='\n\n')
+        print("Dataframe Package:\n", df_package, end='\n\n')
+        print("Dataframe History:\n", df_history, end='\n\n')
+        print("Dataframe PLD:\n", df_pld, end='\n\n')
+        print("Dataframe Merged History:\n", df_merged, end='\n\n')
+    else:
+        print("No dataframes to display.", end='\n\n')
+
+    # Wait until the user clears screen
+    input("Press enter to continue...")
+    
+    
+    
+    
+def display_dates():
     # get file list
     filenames = get_filenames()
     
@@ -754,6 +1371,138 @@ def get_end_date():
     # return the global end date
     end_date = END
     return end_date
+    
+    
+    
+    
+def set_workers(workers):
+    """
+    set_workers(workers) -> None
+    
+    args:
+    workers (int) -> number of processes
+    
+    returns:
+    None
+    
+    Desc:
+    Set the global number of processes used by a parallel build.
+    """
+    global WORKERS
+    
+    # at least one process is needed
+    WORKERS = max(1, int(workers))
+    
+    
+    
+    
+def get_workers():
+    """
+    get_workers() -> workers (int)
+    
+    args:
+    None
+    
+    returns:
+    workers (int) -> number of processes
+    
+    Desc:
+    Get the global number of processes used by a parallel build.
+    """
+    global WORKERS
+    
+    # return the global worker count
+    workers = WORKERS
+    return workers
+
+    
+    
+    
+def set_partitions(period):
+    """
+    set_partitions(period) -> None
+    
+    args:
+    period (string) -> 'day', 'month' or 'none'
+    
+    returns:
+    None
+    
+    Desc:
+    Set the global date partitions the history, PLD and merged history
+    dataframes are saved in. Raises a ValueError for other periods.
+    """
+    global PARTITIONS
+    
+    # only days and months, or no partitions
+    if period not in ['day', 'month', 'none']:
+        raise ValueError("Unknown date partitions: " + str(period))
+    
+    PARTITIONS = period
+    
+    
+    
+    
+def get_partitions():
+    """
+    get_partitions() -> period (string)
+    
+    args:
+    None
+    
+    returns:
+    period (string) -> 'day', 'month', 'none', or None if not set yet
+    
+    Desc:
+    Get the global date partitions the history dataframes are saved in.
+    """
+    global PARTITIONS
+    
+    # return the global partition period
+    period = PARTITIONS
+    return period
+    
+    
+    
+    
+def set_package_ids(ids):
+    """
+    set_package_ids(ids) -> None
+    
+    args:
+    ids (dict) -> <package ID : surrogate>
+    
+    returns:
+    None
+    
+    Desc:
+    Set the global package ID dictionary.
+    """
+    global PACKAGE_IDS
+    
+    PACKAGE_IDS = ids
+    
+    
+    
+    
+def get_package_ids():
+    """
+    get_package_ids() -> ids (dict)
+    
+    args:
+    None
+    
+    returns:
+    ids (dict) -> <package ID : surrogate>, in surrogate order
+    
+    Desc:
+    Get the global package ID dictionary.
+    """
+    global PACKAGE_IDS
+    
+    # return the global package ID dictionary
+    ids = PACKAGE_IDS
+    return ids
 
     
     
@@ -764,26 +1513,22 @@ def set_dataframe(df, df_type):
     
     args:
     df (dataframe object) -> dataframe
-    df_type (string) -> 'aggregate', 'package', or 'history'
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld' or 'merged'
     
     returns:
     None
     
     Desc:
-    Set the global list that stores the built dataframes.
+    Set the global list that stores the built dataframes. The dataframe
+    is marked dirty until it is stored.
     """
     global DATAFRAMES
+    global DIRTY
     
-    if df_type == 'aggregate':
-        DATAFRAMES[0] = df        
-    elif df_type == 'package':
-        DATAFRAMES[1] = df      
-    elif df_type == 'history':
-        DATAFRAMES[2] = df
-    elif df_type == 'pld':
-        DATAFRAMES[3] = df
-    elif df_type == 'merged':
-        DATAFRAMES[4] = df
+    if df_type in DATAFRAME_TYPES:
+        index = DATAFRAME_TYPES.index(df_type)
+        DATAFRAMES[index] = df
+        DIRTY[index] = isinstance(df, pd.DataFrame)
     else:
         print("", end="")
     
@@ -792,34 +1537,105 @@ def set_dataframe(df, df_type):
     
 def get_dataframe(df_type):
     """
-    get_dataframes() -> dataframe (dataframe object)
+    get_dataframes() -> dataframe (dataframe object)
+    
+    args:
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld' or 'merged'
+    
+    returns:
+    dataframe (datetime object) -> selected dataframe
+    
+    Desc:
+    Get a dataframe from the global list that stores the built dataframes.
+    The dataframe is a copy-on-write reference: it shares the column data
+    with the stored dataframe, so columns are replaced, never written into.
+    Released dataframes are loaded again from their file.
+    """
+    global DATAFRAMES
+    
+    df = None
+    if df_type in DATAFRAME_TYPES:
+        index = DATAFRAME_TYPES.index(df_type)
+        
+        # load the dataframe back if it was released
+        if DATAFRAMES[index] is None:
+            DATAFRAMES[index] = load_dataframe(df_type)
+            
+        # a new dataframe object without copying the columns
+        if isinstance(DATAFRAMES[index], pd.DataFrame):
+            df = DATAFRAMES[index].copy(deep=False)
+        else:
+            df = DATAFRAMES[index].copy()
+        
+    return df
+    
+    
+    
+    
+def release_dataframe(df_type):
+    """
+    release_dataframe(df_type) -> released (bool)
+    
+    args:
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld' or 'merged'
+    
+    returns:
+    released (bool) -> if the dataframe was released
+    
+    Desc:
+    Drop a dataframe from the global list when a stage no longer needs it.
+    Only dataframes that are the same as their file are released, the next
+    get_dataframe loads them again.
+    """
+    global DATAFRAMES
+    
+    index = DATAFRAME_TYPES.index(df_type)
+    
+    # dirty dataframes have to be stored first
+    released = isinstance(DATAFRAMES[index], pd.DataFrame) and not DIRTY[index]
+    if released:
+        DATAFRAMES[index] = None
+        
+    return released
+    
+    
+    
+    
+def dataframe_dirty(df_type):
+    """
+    dataframe_dirty(df_type) -> dirty (bool)
+    
+    args:
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld' or 'merged'
+    
+    returns:
+    dirty (bool) -> if the dataframe changed since it was loaded or stored
+    
+    Desc:
+    Get if a dataframe is dirty.
+    """
+    dirty = DIRTY[DATAFRAME_TYPES.index(df_type)]
+    return dirty
+    
+    
+    
+    
+def set_dataframe_clean(df_type):
+    """
+    set_dataframe_clean(df_type) -> None
     
     args:
-    df_type (string) -> 'aggregate', 'package', or 'history'
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld' or 'merged'
     
     returns:
-    dataframe (datetime object) -> selected dataframe
+    None
     
     Desc:
-    Get a dataframe from the global list that stores the built dataframes.
+    Mark a dataframe as the same as its file.
     """
-    global DATAFRAMES
+    global DIRTY
     
-    df = None
-    if df_type == 'aggregate':
-        df = DATAFRAMES[0].copy()
-    elif df_type == 'package':
-        df = DATAFRAMES[1].copy()
-    elif df_type == 'history':
-        df = DATAFRAMES[2].copy()
-    elif df_type == 'pld':
-        df = DATAFRAMES[3].copy()
-    elif df_type == 'merged':
-        df = DATAFRAMES[4].copy()
-    else:
-        df = None
-        
-    return df
+    DIRTY[DATAFRAME_TYPES.index(df_type)] = False
     
     
     
@@ -891,9 +1707,9 @@ def get_error_log(log_type):
 # -------------------------------------------------- DATAFRAME FUNCTIONS --------------------------------->
 # -------------------------------------------------------------------------------------------------------->
 
-def make_aggregate_dataframe(xlsx_file, date):
-    # read Excel sheet
-    df = pd.read_excel(xlsx_file, 'Daily')
+def make_aggregate_dataframe(df_sheet, date):
+    # copy of the parsed 'Daily' sheet
+    df = df_sheet.copy()
     
     # drop total row from dataframe
     df = df.drop(len(df)-1)
@@ -911,7 +1727,7 @@ def make_aggregate_dataframe(xlsx_file, date):
     df = df.sort_values('Provider')
     
     # create an array for the date representing the column to be added to the dataframe
-    array_date = np.full((len(df)), date_to_str(date))
+    array_date = np.full((len(df)), date_to_int(date), dtype=DATE_DTYPE)
     
     # insert the date column column
     df.insert(loc=0, column='Date', value=array_date)
@@ -928,7 +1744,6 @@ def make_aggregate_dataframe(xlsx_file, date):
     df = df[['date', 'provider', 'area_counts', 'pkg_counts', 'pkg_returns', 'pkg_missing']]
     
     # cast types
-    df['date'] = df['date'].astype('string')
     df['provider'] = df['provider'].astype('string')
     df['area_counts'] = df['area_counts'].astype('int')
     df['pkg_counts'] = df['pkg_counts'].astype('int')
@@ -942,9 +1757,9 @@ def make_aggregate_dataframe(xlsx_file, date):
 
 
 
-def make_package_dataframe(xlsx_file, sheet_name):
-    # read Excel sheets
-    df = pd.read_excel(xlsx_file, sheet_name)
+def make_package_dataframe(df_sheet):
+    # copy of the parsed 'SVC' or '85_SVC' sheet
+    df = df_sheet.copy()
     
     # fill any missing 'Service' values as 'S' (Standard service)
     df['Service'] = df['Service'].fillna('S')
@@ -963,107 +1778,35 @@ def make_package_dataframe(xlsx_file, sheet_name):
     
     
     
-def make_history_dataframe(xlsx_file, sheet_name):
-    # read Excel sheets
-    df = pd.read_excel(xlsx_file, sheet_name)
+def make_history_dataframe(df_sheet):
+    # copy of the parsed 'HIST' or '85_HIST' sheet
+    df = df_sheet.copy()
 
     # drop the time stamp
     df = df.drop('Time', axis=1)
     
     # ---------------------------- CONVERT DATES ---------------------------> 
-    # split the date and Day of Week
-    date_split = df['Date'].str.split('\xa0',n=1, expand=True)
-    date_split = date_split.rename(columns={0 : 'Date', 1 : 'DoW'})
-    
-    # loop over all the dates and convert them
-    default_date = '99999999'
-    for i in range(len(date_split['Date'])):
-        # try to reformat the date
-        try:
-            old_date = date_split['Date'].iloc[i].split('/')
-            
-            # concat year
-            if old_date[2] == '99':
-                new_date = default_date
-            else:
-                new_date = '20' + old_date[2]
-                
-                # concat month
-                if len(old_date[0]) < 2:
-                    new_date = new_date + '0' + old_date[0]
-                else:
-                    new_date = new_date + old_date[0]
-                
-                # concat day
-                if len(old_date[1]) < 2:
-                    new_date = new_date + '0' + old_date[1]
-                else:
-                    new_date = new_date + old_date[1]
-        except:
-            # if error reformating date, set to default
-            new_date = default_date
-            
-        date_split['Date'].iloc[i] = new_date
+    # parse every distinct 'm/d/yy\xa0DoW' value once into the date and Day of Week
+    dates, dows = parse_unique(df['Date'], parse_history_date)
     
-    # drop the original date column
-    df = df.drop('Date', axis=1)
-    
-    # merge the reformatted date and DoW back into original dataframe
-    df = df.merge(date_split, how='left', left_index=True, right_index=True)
+    df['Date'] = dates
+    df['DoW'] = dows
     # ------------------------- END CONVERT DATES -------------------------->  
     
     # ------------------------- SPLIT STATION CODES ------------------------>          
-    # replace weird escape sequence and split codes and subcodes
-    station_split = df['Station Code'].str.replace('\xa0\xa0', ' ')
-    station_split = station_split.str.split(' ', n=1, expand=True)
-    
-    # drop un-needed Station Subcodes
-    station_split = station_split.drop(1, axis=1)
-    
-    # rename columns
-    station_split = station_split.rename(columns={0 : 'Station Code'})
-    
-    # replace empty code markers with zero
-    station_split.loc[station_split['Station Code'] == '---', 'Station Code'] = '0'
-    
-    # fill in missing/NaN values and cast as integer type
-    for i in station_split.columns:
-        station_split[i] = station_split[i].str.replace('[a-zA-Z]', '', regex=True)
-        station_split[i] = station_split[i] = station_split[i].fillna(0)
-        station_split[i] = station_split[i].astype('int')
+    # parse every distinct station code once, the subcodes are not needed
+    station_codes, = parse_unique(df['Station Code'], parse_station_code)
     
-    # drop the original Station Codes column
-    df = df.drop(('Station Code'), axis=1)
-    
-    # merge the codes back into the original dataframe
-    df = df.merge(station_split, how='left', left_index=True, right_index=True)
+    df['Station Code'] = station_codes
     # ------------------------- STATION CODES COMPLETE --------------------->
     
     
     # ------------------------- SPLIT DRIVER CODES ------------------------->  
-    # replace weird escape sequence and split codes and subcodes
-    driver_split = df['Driver Code'].str.replace('\xa0\xa0', ' ')
-    driver_split = driver_split.str.split(' ', n=1, expand=True)
-    
-    # rename columns
-    driver_split = driver_split.rename(columns={0 : 'Driver Code', 1 : 'Reason'})
+    # parse every distinct driver code once into the code and reason
+    driver_codes, reasons = parse_unique(df['Driver Code'], parse_driver_code)
     
-    # replace empty code markers with zero
-    driver_split.loc[driver_split['Driver Code'] == '---', 'Driver Code'] = '0'
-    driver_split.loc[driver_split['Reason'] == '---', 'Reason'] = '0'
-    
-    
-    # fill in missing/NaN values and cast as integer type
-    for i in driver_split.columns:
-        driver_split[i] = driver_split[i].str.replace('[a-zA-Z]', '', regex=True)
-        driver_split[i] = driver_split[i] = driver_split[i].fillna(0)
-        driver_split[i] = driver_split[i].astype('int')
-     
-    # drop the original Station Codes column
-    df = df.drop(('Driver Code'), axis=1)
-     
-    # merge the codes back into the original dataframe
-    df = df.merge(driver_split, how='left', left_index=True, right_index=True)
+    df['Driver Code'] = driver_codes
+    df['Reason'] = reasons
     # ------------------------- DRIVER CODES COMPLETE ---------------------->
     
     # rename columns
@@ -1076,8 +1819,10 @@ def make_history_dataframe(xlsx_file, sheet_name):
     df = df[column_order]
     
     # cast column types
-    for i in df[['package_id', 'date', 'dow', 'type']].columns:
+    for i in df[['package_id', 'dow', 'type']].columns:
         df[i] = df[i].astype('string')
+        
+    df['date'] = df['date'].astype(DATE_DTYPE)
 
     # recodedDF = recode_history(df)
     # compress_history(recodedDF)
@@ -1086,15 +1831,138 @@ def make_history_dataframe(xlsx_file, sheet_name):
 
 
 
-def make_pld_dataframe(xlsx_file,  sheet_name, date):
-    # read Excel sheet
-    df = pd.read_excel(xlsx_file, sheet_name)
+def parse_unique(series, parser):
+    """
+    parse_unique(series, parser) -> columns (list)
+    
+    args:
+    series (series) -> column of raw values
+    parser (function) -> parses one raw value into a tuple of values
+    
+    returns:
+    columns (list) -> one array per value in the parser's tuple
+    
+    Desc:
+    Parse every distinct value of a column only once, then map the results
+    back to all the rows by their factorized codes.
+    """
+    # codes of the distinct values, missing values get code -1
+    codes, uniques = pd.factorize(series)
+    
+    # parse the distinct values, the missing value is parsed last so code -1 maps to it
+    parsed = [parser(v) for v in uniques]
+    parsed.append(parser(np.nan))
+    
+    # gather the parsed values for every row
+    columns = []
+    for values in zip(*parsed):
+        array = np.empty(len(values), dtype='object')
+        array[:] = values
+        
+        # integer values are kept as an integer array
+        if all(type(v) == int for v in values):
+            array = array.astype('int64')
+            
+        columns.append(array[codes])
+        
+    return columns
+
+
+
+
+def parse_history_date(value):
+    # default date for missing or unreadable dates
+    default_date = 99999999
+    
+    # not a date string
+    if not isinstance(value, str):
+        return default_date, None
+    
+    # split the date and Day of Week
+    date_split = value.split('\xa0', 1)
+    dow = date_split[1] if len(date_split) > 1 else None
+    
+    # try to reformat the date from m/d/yy to yyyymmdd
+    try:
+        old_date = date_split[0].split('/')
+        
+        # concat year
+        if old_date[2] == '99':
+            new_date = default_date
+        else:
+            new_date = '20' + old_date[2]
+            
+            # concat month and day
+            for part in [old_date[0], old_date[1]]:
+                if len(part) < 2:
+                    new_date = new_date + '0' + part
+                else:
+                    new_date = new_date + part
+                    
+            # the date as a yyyymmdd integer, longer or shorter dates are unreadable
+            if len(new_date) != 8:
+                raise ValueError(new_date)
+            new_date = int(new_date)
+    except Exception:
+        # if error reformating date, set to default
+        new_date = default_date
+        
+    return new_date, dow
+
+
+
+
+def parse_code(value):
+    # missing codes are zero
+    if value is None:
+        return 0
+    
+    # replace empty code markers with zero
+    if value == '---':
+        value = '0'
+        
+    # remove letters and cast as integer
+    return int(CODE_LETTERS.sub('', value))
+
+
+
+
+def parse_station_code(value):
+    # missing codes are zero
+    if not isinstance(value, str):
+        return (0,)
+    
+    # replace weird escape sequence and split codes and subcodes
+    code_split = value.replace('\xa0\xa0', ' ').split(' ', 1)
+    
+    return (parse_code(code_split[0]),)
+
+
+
+
+def parse_driver_code(value):
+    # missing codes are zero
+    if not isinstance(value, str):
+        return 0, 0
+    
+    # replace weird escape sequence and split codes and reasons
+    code_split = value.replace('\xa0\xa0', ' ').split(' ', 1)
+    reason = code_split[1] if len(code_split) > 1 else None
+    
+    return parse_code(code_split[0]), parse_code(reason)
+
+
+
+
+def make_pld_dataframe(df_sheet, date):
+    # copy of the parsed 'PLD' or '85' sheet
+    df = df_sheet.copy()
     
     # drop Count and Time columns
     df = df.drop(['Count', 'Time'], axis=1)
     
     # create an array for the date representing the column to be added to the dataframe
-    array_date = np.full((len(df)), date_to_str(date))
+    array_date = np.full((len(df)), date_to_int(date), dtype=DATE_DTYPE)
     
     # insert the date column column
     df.insert(loc=0, column='Date', value=array_date)
@@ -1128,9 +1996,6 @@ def make_pld_dataframe(xlsx_file,  sheet_name, date):
     df['station_code'] = df['station_code'].astype('int')  
     df['driver_code'] = df['driver_code'].fillna(0)
     df['driver_code'] = df['driver_code'].astype('int')
-    
-    
-    df['date'] = df['date'].astype('string')
     # ------------------- END FILL AND CAST ---------------------------->
     
     return df
@@ -1141,25 +2006,10 @@ def make_pld_dataframe(xlsx_file,  sheet_name, date):
 def index_history(df_history):
     df = df_history.copy()
     
-    # add empty column for the order of events
-    array_order = np.full((len(df)), 0, dtype='int')
+    # add the column for the order of events, numbered in one grouped pass
+    array_order = order_events(df)
     df.insert(loc=0, column='order', value=array_order)
     
-    # get unique package IDs
-    pkgs = pd.unique(df['package_id'])
-    
-    # progress bar
-    pbar = tqdm(pkgs)
-    pbar.set_description("Event indexing")
-    
-    # loop over individual package IDs and index history entries
-    for i in pbar:
-        df_pkg = df[df['package_id'] == i]
-        pkg_indexer = 0
-        for j in df_pkg.index:
-            df.at[j, 'order'] = pkg_indexer
-            pkg_indexer += 1
-    
     # reorder columns
     column_order = ['package_id', 'order', 'date', 'dow', 'type', 'station_code', 'driver_code', 'reason']
     df = df[column_order]
@@ -1169,13 +2019,93 @@ def index_history(df_history):
 
 
 
-def check_df_is_empty(xlsx_file, df_type):
-    # read Excel sheet
-    df = pd.read_excel(xlsx_file, df_type)
+def order_events(df_history, pkg_ids=None):
+    """
+    order_events(df_history, pkg_ids) -> array_order (numpy array)
+    
+    args:
+    df_history (dataframe) -> history dataframe
+    pkg_ids (list-like) -> packages to renumber, None for all packages
+    
+    returns:
+    array_order (numpy array) -> event order for every row of df_history
+    
+    Desc:
+    Number the events of every package from 0 in the order of its rows,
+    in one grouped pass. If pkg_ids is given, only those packages are
+    renumbered and the other rows keep their current 'order' value.
+    """
+    # rows without a package ID (-1) are left at 0
+    no_id = df_history['package_id'].to_numpy() < 0
+    
+    # all the packages
+    if pkg_ids is None:
+        order = df_history.groupby('package_id', sort=False).cumcount()
+        array_order = order.fillna(0).to_numpy(dtype='int')
+        array_order[no_id] = 0
+        return array_order
+    
+    # only the rows of the selected packages
+    mask = df_history['package_id'].isin(pkg_ids).to_numpy()
+    order = df_history[mask].groupby('package_id', sort=False).cumcount()
+    
+    array_order = df_history['order'].to_numpy(dtype='int', copy=True)
+    array_order[mask] = order.fillna(0).to_numpy(dtype='int')
+    array_order[mask & no_id] = 0
+    
+    return array_order
+
+
+
+
+def intern_package_ids(series):
+    """
+    intern_package_ids(series) -> surrogates (numpy array)
+    
+    args:
+    series (series) -> package IDs
+    
+    returns:
+    surrogates (numpy array) -> int32 surrogate of every package ID
+    
+    Desc:
+    Map package IDs to dense integer surrogates through the global package ID
+    dictionary. New package IDs are added in order of first appearance and
+    missing package IDs get -1.
+    """
+    # get the package ID dictionary
+    ids = get_package_ids()
+    
+    # add the new package IDs
+    values = series.astype('object')
+    missing = values.isna().to_numpy()
+    for i in pd.unique(values[~missing]):
+        if i not in ids:
+            ids[i] = len(ids)
+            
+    # map every package ID to its surrogate
+    surrogates = values.map(ids).fillna(-1).to_numpy().astype(ID_DTYPE)
     
+    return surrogates
+
+
+
+
+def intern_workbooks(workbooks):
+    # intern the package IDs of every sheet in file and build order
+    for fragments, errors in workbooks:
+        for sheet in WORKBOOK_SHEETS:
+            df_sheet = fragments.get(sheet)
+            if df_sheet is not None and 'package_id' in df_sheet.columns:
+                df_sheet['package_id'] = intern_package_ids(df_sheet['package_id'])
+
+
+
+
+def check_df_is_empty(df_sheet):
     # True if df is empty, False if populated
     is_empty = False
-    if df.empty:
+    if df_sheet.empty:
         is_empty = True
         
     return is_empty
@@ -1183,18 +2113,298 @@ def check_df_is_empty(xlsx_file, df_type):
 
 
 
-def compare_dataframe(df_target, df_concat):
-    target_pkgs = pd.unique(df_target['package_id'])
+def drop_seen_packages(df_concat, seen_ids):
+    """
+    drop_seen_packages(df_concat, seen_ids) -> df (dataframe)
+    
+    args:
+    df_concat (dataframe) -> dataframe you want to concat
+    seen_ids (set) -> package IDs already accumulated, updated in place
+    
+    returns:
+    df (dataframe) -> rows of the packages not seen before
+    
+    Desc:
+    Remove the packages that were already seen from a dataframe with a single
+    anti-join, then add its remaining packages to the seen set. The cost only
+    depends on the size of the incoming dataframe.
+    """
+    # unique package IDs of the incoming dataframe
     concat_pkgs = pd.unique(df_concat['package_id'])
     
-    df = df_concat.copy()
+    # hash set lookups for the packages that have not been seen yet
+    new_pkgs = [i for i in concat_pkgs if i not in seen_ids]
     
-    # remove packages from the dataframe that you want to concat
-    for i in target_pkgs:
-        if i in concat_pkgs:
-            df = df[df['package_id'] != i]
+    # keep the rows of the new packages only
+    if len(new_pkgs) == len(concat_pkgs):
+        df = df_concat
+    else:
+        df = df_concat[df_concat['package_id'].isin(new_pkgs)]
+        
+    # the new packages are now seen
+    seen_ids.update(new_pkgs)
             
     return df
+
+
+
+
+def parse_workbook(file):
+    """
+    parse_workbook(file) -> fragments (dict), errors (dict)
+    
+    args:
+    file (string) -> path to a PACKAGE_yyyymmdd workbook
+    
+    returns:
+    fragments (dict) -> sheet name : dataframe (None if an '85' sheet is empty)
+    errors (dict) -> sheet name : [df_name, file, err]
+    
+    Desc:
+    Open a daily workbook once and build the aggregate, package, history
+    and PLD fragments from all of its sheets in a single pass.
+    """
+    fragments = {}
+    errors = {}
+    
+    try:
+        # load the Excel file only once
+        xlsx = pd.ExcelFile(file)
+    except Exception as err:
+        # every sheet of the workbook failed
+        return fragments, workbook_errors(file, err)
+    
+    with xlsx:
+        # get the file date
+        xlsx_date = capture_file_date(file)
+        
+        # parse every sheet from the open workbook
+        for sheet in WORKBOOK_SHEETS:
+            try:
+                df_sheet = xlsx.parse(sheet)
+                
+                if sheet == 'Daily':
+                    fragments[sheet] = make_aggregate_dataframe(df_sheet, xlsx_date)
+                    
+                elif sheet == 'SVC':
+                    fragments[sheet] = make_package_dataframe(df_sheet)
+                    
+                elif sheet == 'HIST':
+                    fragments[sheet] = make_history_dataframe(df_sheet)
+                    
+                elif sheet in ['85_SVC', '85_HIST']:
+                    # the 85 sheets are often empty
+                    if check_df_is_empty(df_sheet):
+                        fragments[sheet] = None
+                    elif sheet == '85_SVC':
+                        fragments[sheet] = make_package_dataframe(df_sheet)
+                    else:
+                        fragments[sheet] = make_history_dataframe(df_sheet)
+                        
+                else:
+                    fragments[sheet] = make_pld_dataframe(df_sheet, xlsx_date)
+                    
+            except Exception as err:
+                errors[sheet] = [WORKBOOK_SHEETS[sheet], file, err]
+    
+    return fragments, errors
+
+
+
+
+def workbook_errors(file, err):
+    # log the same error for every sheet of a workbook that could not be parsed
+    errors = {}
+    for sheet, df_name in WORKBOOK_SHEETS.items():
+        errors[sheet] = [df_name, file, err]
+        
+    return errors
+
+
+
+
+def parse_workbooks(files, parallel=False):
+    """
+    parse_workbooks(files, parallel) -> workbooks (list)
+    
+    args:
+    files (string tuple) -> workbook filenames
+    parallel (bool) -> parse the files in a process pool
+    
+    returns:
+    workbooks (list) -> (fragments, errors) of every file, in file order
+    
+    Desc:
+    Parse all the workbooks, either one at a time or spread over
+    get_workers() processes. Results keep the order of the file list
+    so a parallel build matches the serial build.
+    """
+    workbooks = []
+    workers = get_workers()
+    
+    # parse one file at a time
+    if parallel == False or workers <= 1:
+        pbar = tqdm(files)
+        pbar.set_description('Workbooks')
+        for file in pbar:
+            workbooks.append(parse_workbook(file))
+            
+        return workbooks
+    
+    # fan the files out to the process pool
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(parse_workbook, file) for file in files]
+        
+        # collect the results in file order
+        pbar = tqdm(zip(files, futures), total=len(files))
+        pbar.set_description('Workbooks (' + str(workers) + ' workers)')
+        for file, future in pbar:
+            try:
+                workbooks.append(future.result())
+            except Exception as err:
+                # the worker itself failed, log it for every sheet
+                workbooks.append(({}, workbook_errors(file, err)))
+                
+    return workbooks
+
+
+
+
+def load_workbooks(files, parallel=False):
+    """
+    load_workbooks(files, parallel) -> workbooks (list)
+    
+    args:
+    files (string tuple) -> workbook filenames
+    parallel (bool) -> parse the files in a process pool
+    
+    returns:
+    workbooks (list) -> (fragments, errors) of every file, in file order
+    
+    Desc:
+    Get the parsed workbooks from the parse cache and only parse the files
+    that are new or changed. Workbooks parsed without errors are cached.
+    """
+    # the hashes of the workbooks seen before
+    cache_index = load_cache_index()
+    
+    # workbooks in file order, filled from the cache first
+    workbooks = [None] * len(files)
+    keys = []
+    missing = []
+    for i, file in enumerate(files):
+        try:
+            key = workbook_cache_key(file, cache_index)
+            fragments = load_cached_workbook(key)
+        except Exception:
+            key = None
+            fragments = None
+            
+        keys.append(key)
+        if fragments is not None:
+            workbooks[i] = (fragments, {})
+        else:
+            missing.append(i)
+    
+    print("Workbooks in parse cache:", len(files) - len(missing))
+    print("Workbooks to parse:", len(missing))
+    
+    # parse the new or changed files
+    parsed = parse_workbooks([files[i] for i in missing], parallel)
+    
+    # store the parsed workbooks in the cache
+    for i, (fragments, errors) in zip(missing, parsed):
+        workbooks[i] = (fragments, errors)
+        if len(errors) == 0 and keys[i] is not None:
+            store_cached_workbook(keys[i], fragments)
+    
+    # save the updated hashes
+    store_cache_index(cache_index)
+    
+    return workbooks
+
+
+
+
+def collect_sheet(workbooks, sheet, build_error_log):
+    # list of the sheet's dataframes in file order
+    df_list = []
+    
+    # for every parsed workbook
+    for fragments, errors in workbooks:
+        # log the sheet's error, or keep the dataframe if it is not empty
+        if sheet in errors:
+            build_error_log.append(errors[sheet])
+        elif fragments[sheet] is not None:
+            df_list.append(fragments[sheet])
+            
+    return df_list
+
+
+
+
+def sheet_package_ids(workbooks, sheet):
+    # all the package IDs found in the sheet of every workbook
+    ids = set()
+    for fragments, errors in workbooks:
+        if fragments.get(sheet) is not None:
+            ids.update(fragments[sheet]['package_id'])
+            
+    return ids
+
+
+
+
+def append_package_sheets(df_target, workbooks, sheets, ids_85, build_error_log):
+    """
+    append_package_sheets(df_target, workbooks, sheets, ids_85, build_error_log)
+        -> df_target (dataframe), df_added (dataframe), ids_85 (set)
+    
+    args:
+    df_target (dataframe) -> existing package or history dataframe
+    workbooks (list) -> parsed new workbooks
+    sheets (list) -> main and '85' sheet names, ['SVC', '85_SVC'] or ['HIST', '85_HIST']
+    ids_85 (set) -> package IDs in df_target only found in '85' sheets
+    build_error_log (list) -> build errors
+    
+    returns:
+    df_target (dataframe) -> existing rows that are kept
+    df_added (dataframe) -> new rows from the new workbooks
+    ids_85 (set) -> updated package IDs only found in '85' sheets
+    
+    Desc:
+    Get the rows of new workbooks with the same first-file-wins rules as a
+    full build, where the main sheets of all files come before the '85' sheets.
+    Packages only found in '85' sheets so far are replaced by a main sheet entry.
+    """
+    # packages from an earlier main sheet keep their rows
+    kept_ids = set(pd.unique(df_target['package_id'])) - ids_85
+    
+    # new rows from the main sheet, first file wins
+    seen_ids = set(kept_ids)
+    df_list = []
+    for df_xlsx in collect_sheet(workbooks, sheets[0], build_error_log):
+        df_list.append(drop_seen_packages(df_xlsx, seen_ids))
+        
+    # packages only from an earlier '85' sheet are replaced
+    replaced_ids = ids_85 & (seen_ids - kept_ids)
+    df_target = df_target[~df_target['package_id'].isin(replaced_ids)]
+    ids_85 = ids_85 - replaced_ids
+    
+    # new rows from the '85' sheet for packages not seen anywhere yet
+    seen_ids.update(ids_85)
+    for df_xlsx in collect_sheet(workbooks, sheets[1], build_error_log):
+        df_xlsx = drop_seen_packages(df_xlsx, seen_ids)
+        ids_85 = ids_85 | set(pd.unique(df_xlsx['package_id']))
+        df_list.append(df_xlsx)
+    
+    # concat the new rows once, an empty dataframe if there are none
+    if df_list:
+        df_added = pd.concat(df_list)
+    else:
+        df_added = pd.DataFrame(columns=['package_id']).astype(ID_DTYPE)
+        
+    return df_target, df_added, ids_85
 # -------------------------------------------------------------------------------------------------------->    
 # ---------------------------------------------- END DATAFRAME FUNCTIONS --------------------------------->
 # -------------------------------------------------------------------------------------------------------->
@@ -1204,48 +2414,54 @@ def compare_dataframe(df_target, df_concat):
 # -------------------------------------------------------------------------------------------------------->
 # -------------------------------------------------- BUILD DATA ------------------------------------------>
 # -------------------------------------------------------------------------------------------------------->
-def build_data():
+def build_data(parallel=False):
     # ------------------- initialize dataframes -------------------->
     print("\nInitializing dataframes...")
     
     # get filenames
     files = get_filenames()
     
-    # initialize all dataframes
+    # initialize all dataframes, the package IDs and dates are integers from the start
     df_aggregate = pd.DataFrame(columns=["date", "area_counts", "pkg_counts", "pkg_returns", "pkg_missing"])
+    df_aggregate = df_aggregate.astype({'date' : DATE_DTYPE})
     
     df_package = pd.DataFrame(columns=['package_id', 'service', 'signature'])
+    df_package = df_package.astype({'package_id' : ID_DTYPE})
     
     df_history = pd.DataFrame(columns=['package_id', 'date', 'dow', 'type', 'station_code', \
                                        'driver_code', 'reason'])
+    df_history = df_history.astype({'package_id' : ID_DTYPE, 'date' : DATE_DTYPE})
                                        
     df_pld = pd.DataFrame(columns=['package_id', 'zipcode', 'provider', \
                                    'assigned_area', 'loaded_area', 'station_code', \
                                    'driver_code', 'date'])
+    df_pld = df_pld.astype({'package_id' : ID_DTYPE, 'date' : DATE_DTYPE})
     
     print("Dataframe initialization complete.", end='\n\n')
     # ------------------- initialization complete ------------------>
     
     # list that hold errors for dataframe building
     build_error_log = []
+    
+    # ------------------- parse the workbooks ---------------------->
+    # open every file once and parse all of its sheets
+    print("\nParsing workbooks...")
+    workbooks = load_workbooks(files, parallel)
+    
+    # a new build numbers the packages from 0 again
+    set_package_ids({})
+    intern_workbooks(workbooks)
+        
+    # completion message
+    print("Workbook parsing complete.", end='\n\n')
+    # ------------------- parsing complete ------------------------->
+    
+    
     # ---------------- build the aggregate dataframe --------------->   
-    # loop over the rest of the files and append aggregate data to the dataframe
-    print("\nBuilding aggregate dataframe...")
-    pbar = tqdm(files)
-    pbar.set_description('Daily')
-    for file in pbar:
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            xlsx_date = capture_file_date(file)
-            
-            # create dataframe from file and append to aggregate dataframe
-            df_xlsx = make_aggregate_dataframe(xlsx, xlsx_date)
-            df_aggregate = pd.concat([df_aggregate, df_xlsx])
-            
-        except Exception as err:
-                df_name = 'df_aggregate (Daily)'
-                build_error_log.append([df_name, file, err])
+    # append the aggregate data of every file to the dataframe
+    print("Building aggregate dataframe...")
+    df_list = [df_aggregate] + collect_sheet(workbooks, 'Daily', build_error_log)
+    df_aggregate = pd.concat(df_list)
     
     # reset indices for the dataframe
     df_aggregate = df_aggregate.reset_index(drop=True)
@@ -1256,47 +2472,18 @@ def build_data():
     
     
     # ----------------- build the package dataframe ---------------->
-    # loop over the rest of the files and append package data to the dataframe
+    # append the package data of every file to the dataframe
+    # the first file a package is seen in wins
     print("Building package dataframe...")
-    # process for PLD data
-    pbar = tqdm(files)
-    pbar.set_description('SVC')
-    for file in pbar:
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            
-            # create dataframe from file and append to package dataframe
-            df_xlsx = make_package_dataframe(xlsx, 'SVC')
-            df_xlsx = compare_dataframe(df_package, df_xlsx)
-            df_package = pd.concat([df_package, df_xlsx])
-        
-        except Exception as err:
-                df_name = 'df_package (SVC)'
-                build_error_log.append([df_name, file, err])
-                
-    # process for 85 data
-    pbar = tqdm(files)
-    pbar.set_description('85_SVC')
-    for file in pbar:     
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            
-            # check to see if the dataframe is empty first
-            is_empty = check_df_is_empty(xlsx, '85_SVC')
-            
-            if is_empty != True:
-                # create dataframe from file and append to package dataframe
-                df_xlsx = make_package_dataframe(xlsx, '85_SVC')
-                df_xlsx = compare_dataframe(df_package, df_xlsx)
-                df_package = pd.concat([df_package, df_xlsx])
-        
-        except Exception as err:
-                df_name = 'df_package (85_SVC)'
-                build_error_log.append([df_name, file, err])
+    seen_ids = set()
+    df_list = [df_package]
+    for sheet in ['SVC', '85_SVC']:
+        for df_xlsx in collect_sheet(workbooks, sheet, build_error_log):
+            df_list.append(drop_seen_packages(df_xlsx, seen_ids))
+    
+    # concat all the files once
+    df_package = pd.concat(df_list)
                 
-                    
     # drop any duplicate in the dataframe
     df_package = df_package.drop_duplicates(subset=['package_id'])
     
@@ -1308,46 +2495,19 @@ def build_data():
     # ----------------- package dataframe complete ----------------->
     
     
-    # ----------------- build the history dataframe ---------------->   
-    # loop over the rest of the files and append history data to the dataframe
-    print("Building history dataframe...")
-    pbar = tqdm(files)
-    pbar.set_description('HIST')
-    for file in pbar:
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            
-            # create dataframe from file and append to history dataframe
-            df_xlsx = make_history_dataframe(xlsx, 'HIST')
-            df_xlsx = compare_dataframe(df_history, df_xlsx)
-            df_history = pd.concat([df_history, df_xlsx])
-        
-        except Exception as err:
-                df_name = 'df_history (HIST)'
-                build_error_log.append([df_name, file, err])
-                
-    # process for 85 data
-    pbar = tqdm(files)
-    pbar.set_description('85_HIST')
-    for file in pbar:     
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            
-            # check to see if the dataframe is empty first
-            is_empty = check_df_is_empty(xlsx, '85_HIST')
-            
-            if is_empty != True:
-                # create dataframe from file and append to package dataframe
-                df_xlsx = make_history_dataframe(xlsx, '85_HIST')
-                df_xlsx = compare_dataframe(df_history, df_xlsx)
-                df_history = pd.concat([df_history, df_xlsx])
-        
-        except Exception as err:
-            df_name = 'df_history (85_HIST)'
-            build_error_log.append([df_name, file, err])
-    
+    # ----------------- build the history dataframe ---------------->   
+    # append the history data of every file to the dataframe
+    # the first file a package is seen in wins
+    print("Building history dataframe...")
+    seen_ids = set()
+    df_list = [df_history]
+    for sheet in ['HIST', '85_HIST']:
+        for df_xlsx in collect_sheet(workbooks, sheet, build_error_log):
+            df_list.append(drop_seen_packages(df_xlsx, seen_ids))
+    
+    # concat all the files once
+    df_history = pd.concat(df_list)
+    
     # drop any duplicate in the dataframe
     df_history = df_history.drop_duplicates()
     
@@ -1363,40 +2523,14 @@ def build_data():
     
     
     # ----------------- build the PLD dataframe -------------------->
-    # loop over the rest of the files and append history data to the dataframe
+    # append the PLD data of every file to the dataframe
     print("Building PLD dataframe...")
-    pbar = tqdm(files)
-    pbar.set_description('PLD')
-    for file in pbar:
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            xlsx_date = capture_file_date(file)
-            
-            # create dataframe from file and append to history dataframe
-            df_xlsx = make_pld_dataframe(xlsx, 'PLD', xlsx_date)
-            df_pld = pd.concat([df_pld, df_xlsx])
-            
-        except Exception as err:
-            df_name = 'df_pld (PLD)'
-            build_error_log.append([df_name, file, err])
-        
-    # build 85 data
-    pbar = tqdm(files)
-    pbar.set_description('85')
-    for file in pbar:
-        try:
-            # load Excel file and file date
-            xlsx = pd.ExcelFile(file)
-            xlsx_date = capture_file_date(file)
-            
-            # create dataframe from file and append to history dataframe
-            df_xlsx = make_pld_dataframe(xlsx, '85', xlsx_date)
-            df_pld = pd.concat([df_pld, df_xlsx])
-            
-        except Exception as err:
-            df_name = 'df_pld (85)'
-            build_error_log.append([df_name, file, err])
+    df_list = [df_pld]
+    for sheet in ['PLD', '85']:
+        df_list += collect_sheet(workbooks, sheet, build_error_log)
+    
+    # concat all the files once
+    df_pld = pd.concat(df_list)
                 
     # drop any duplicate in the dataframe
     df_pld = df_pld.drop_duplicates()
@@ -1418,15 +2552,33 @@ def build_data():
     # !!! BUILDING DATA IS NOW COMPLETE !!!
     
     # ----------------- Finishing Processes ------------------------>
+    # compact column types for all the dataframes
+    df_aggregate = apply_schema(df_aggregate, 'aggregate')
+    df_package = apply_schema(df_package, 'package')
+    df_history = apply_schema(df_history, 'history')
+    df_pld = apply_schema(df_pld, 'pld')
+    
     # store built dataframes in our global list
     set_dataframe(df_aggregate, 'aggregate')
     set_dataframe(df_package, 'package')
     set_dataframe(df_history, 'history')
     set_dataframe(df_pld, 'pld')
     
+    # the merged history holds the package IDs of the old numbering, it
+    # has to be merged again from the new dataframes
+    set_dataframe([], 'merged')
+    remove_dataframe(os.path.join(get_path('output'), DATAFRAME_FILES[DATAFRAME_TYPES.index('merged')]))
+    
     # save the dataframes in a file
     df_save_success = store_dataframes()
     
+    # save the files in the dataframes and the packages only found in '85'
+    # sheets, so new files can be appended later
+    manifest = {'files' : list(files), \
+                'packages_85' : set(df_package['package_id']) - sheet_package_ids(workbooks, 'SVC'), \
+                'history_85' : set(df_history['package_id']) - sheet_package_ids(workbooks, 'HIST')}
+    store_ingest_manifest(manifest)
+    
     # Get the error counts
     build_error_count = len(build_error_log)
     #merge_error_count = len(merge_error_log)
@@ -1458,6 +2610,151 @@ def build_data():
 
 
 
+# -------------------------------------------------------------------------------------------------------->
+# -------------------------------------------------- APPEND DATA ----------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+def append_data(parallel=False):
+    # get the manifest of files already built into the dataframes
+    manifest = load_ingest_manifest()
+    
+    # get the current built dataframes
+    df_aggregate = get_dataframe('aggregate')
+    df_package = get_dataframe('package')
+    df_history = get_dataframe('history')
+    df_pld = get_dataframe('pld')
+    
+    # nothing to append to, build everything instead
+    if manifest is None or len(df_history) == 0:
+        print("\nNo previous build found. Building all dataframes...")
+        build_data(parallel)
+        return
+    
+    # look for files placed in the data directory since the start
+    set_filenames([])
+    capture_filenames()
+    
+    # only the files that are not in the dataframes yet
+    files = [f for f in get_filenames() if f not in manifest['files']]
+    
+    if len(files) == 0:
+        print("\nNo new files to append.", end='\n\n')
+        input("Press enter to continue...")
+        return
+    
+    # keep the existing build errors
+    build_error_log = list(get_error_log('build'))
+    
+    # ------------------- parse the new workbooks ------------------>
+    print("\nParsing new workbooks...")
+    workbooks = load_workbooks(files, parallel)
+    intern_workbooks(workbooks)
+    print("Workbook parsing complete.", end='\n\n')
+    # ------------------- parsing complete ------------------------->
+    
+    
+    # ----------------- append aggregate data ---------------------->
+    print("Appending aggregate data...")
+    df_list = [df_aggregate] + collect_sheet(workbooks, 'Daily', build_error_log)
+    df_aggregate = pd.concat(df_list)
+        
+    df_aggregate = df_aggregate.reset_index(drop=True)
+    print("Aggregate data appended.", end='\n\n')
+    # ----------------- aggregate data complete -------------------->
+    
+    
+    # ----------------- append package data ------------------------>
+    print("Appending package data...")
+    df_package, df_new_package, manifest['packages_85'] = \
+        append_package_sheets(df_package, workbooks, ['SVC', '85_SVC'], \
+                              manifest['packages_85'], build_error_log)
+    
+    df_package = pd.concat([df_package, df_new_package])
+    df_package = df_package.drop_duplicates(subset=['package_id'])
+    df_package = df_package.reset_index(drop=True)
+    print("Package data appended.", end='\n\n')
+    # ----------------- package data complete ---------------------->
+    
+    
+    # ----------------- append history data ------------------------>
+    print("Appending history data...")
+    df_history, df_new_history, manifest['history_85'] = \
+        append_package_sheets(df_history, workbooks, ['HIST', '85_HIST'], \
+                              manifest['history_85'], build_error_log)
+    
+    df_new_history = df_new_history.drop_duplicates()
+    df_new_history = df_new_history.reset_index(drop=True)
+    
+    # index the events of the new and replaced packages only
+    df_new_history = index_history(df_new_history)
+    
+    df_history = pd.concat([df_history, df_new_history])
+    df_history = df_history.reset_index(drop=True)
+    print("History data appended.", end='\n\n')
+    # ----------------- history data complete ---------------------->
+    
+    
+    # ----------------- append PLD data ---------------------------->
+    print("Appending PLD data...")
+    df_list = [df_pld]
+    for sheet in ['PLD', '85']:
+        df_list += collect_sheet(workbooks, sheet, build_error_log)
+        
+    df_pld = pd.concat(df_list)
+    
+    df_pld = df_pld.drop_duplicates()
+    df_pld = df_pld.reset_index(drop=True)
+    print("PLD data appended.", end='\n\n')
+    # ----------------- PLD data complete -------------------------->
+    
+    
+    # ----------------- Finishing Processes ------------------------>
+    # compact column types again, the new rows come in with wider types
+    df_aggregate = apply_schema(df_aggregate, 'aggregate')
+    df_package = apply_schema(df_package, 'package')
+    df_history = apply_schema(df_history, 'history')
+    df_pld = apply_schema(df_pld, 'pld')
+    
+    # store appended dataframes in our global list
+    set_dataframe(df_aggregate, 'aggregate')
+    set_dataframe(df_package, 'package')
+    set_dataframe(df_history, 'history')
+    set_dataframe(df_pld, 'pld')
+    
+    # save the dataframes in a file
+    df_save_success = store_dataframes()
+    
+    # add the new files to the manifest and update the date range
+    manifest['files'] = list(manifest['files']) + files
+    store_ingest_manifest(manifest)
+    update_date_range(manifest['files'])
+    
+    # store the error logs in our global list and save them
+    set_error_log(build_error_log, 'build')
+    err_save_success = store_error_logs()
+    
+    # prompt user with success and error counts
+    print("----------------------------------")
+    print("-------DATA APPEND SUCCESS--------")
+    print("----------------------------------")
+    print("Files appended:", len(files))
+    print("Packages with new history events:", len(pd.unique(df_new_history['package_id'])))
+    print("Total sample size (Packages):", len(df_package))
+    print("Build errors:", len(build_error_log))
+    print("Start Date:", get_start_date())
+    print("End Date:", get_end_date())
+    print("Dataframes successfully saved:", df_save_success)
+    print("Error logs successfully saved:", err_save_success, end='\n\n')
+    print("Merge the dataframes again to include the new files.", end='\n\n')
+    
+    # hold screen until pressing enter
+    input("Press enter to continue...")
+# -------------------------------------------------------------------------------------------------------->
+# ---------------------------------------------- END APPEND DATA ----------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+
 # -------------------------------------------------------------------------------------------------------->
 # -------------------------------------------------- MERGE DATA ------------------------------------------>
 # -------------------------------------------------------------------------------------------------------->
@@ -1466,119 +2763,458 @@ def history_merge_pld():
     df_history = get_dataframe('history')
     df_pld = get_dataframe('pld')
     
-    # new dataframe for merging
-    merged_dataframe = df_history.copy()
+    # the other dataframes are not needed for merging, the old merged history gets replaced
+    for df_type in ['aggregate', 'package', 'merged']:
+        release_dataframe(df_type)
+    
+    # ------------------------------------------- MERGING CODE ------------------------------>
+    print("Merging df_history and df_pld...")
+    merged_dataframe, merge_error_log = merge_pld(df_history, df_pld)
+    errors = len(merge_error_log)
+    # --------------------------------------- END MERGING CODE ------------------------------>
+    
+    # set and save dataframe
+    set_dataframe(merged_dataframe, 'merged')
+    save_success = store_dataframes()
+    
+    #set and save error logs
+    set_error_log(merge_error_log, 'merge')
+    save_log_success = store_error_logs()
+    
+    print("----------------------------------")
+    print("---------MERGE SUCCESS------------")
+    print("----------------------------------")
+    print("Merging completed.")
+    print("Merge errors:", errors)
+    print("\n\n")            
+    print("Dataframe saved successfully:", save_success)
+    print("Error log saved successfully:", save_log_success)
+    print("\n\n")
+    input("Press enter to continue...")
 
-    # all the unique package IDs from the history dataframe
-    history_idx = pd.unique(df_history['package_id'])
+
+
+
+def merge_pld(df_history, df_pld):
+    """
+    merge_pld(df_history, df_pld) -> merged_dataframe (dataframe), merge_error_log (list)
+    
+    args:
+    df_history (dataframe) -> history dataframe
+    df_pld (dataframe) -> PLD dataframe
+    
+    returns:
+    merged_dataframe (dataframe) -> history with the PLD columns
+    merge_error_log (list) -> [package_id, date, err] of PLD rows with no history entry
     
-    # add PLD columns to the history dataframe
-    pld_columns = df_pld[['provider', 'assigned_area', 'loaded_area', 'zipcode']].columns
+    Desc:
+    Merge the PLD data into the first history entry of the same package and
+    date with one keyed join. When a package has several PLD rows for the same
+    date, the last one is kept. PLD rows of history packages that have no
+    entry for their date are returned in the error log.
+    """
+    # new dataframe for merging, the history columns are shared and never written into
+    merged_dataframe = df_history.copy(deep=False)
     
     # build blank columns for PLD data
-    array_provider = np.full((len(merged_dataframe)), '', dtype='str')
+    array_provider = np.full((len(merged_dataframe)), '', dtype='object')
     array_assigned_area = np.full((len(merged_dataframe)), 0, dtype='int')
     array_loaded_area = np.full((len(merged_dataframe)), 0, dtype='int')
     array_zipcode = np.full((len(merged_dataframe)), 0, dtype='int')
     
-    # insert new columns into package's history dataframe
+    # ---------------------------- FIRST HISTORY ENTRIES ------------------------------------>
+    # row position of the first history entry for every package and date
+    df_first = pd.DataFrame({'package_id' : df_history['package_id'].to_numpy(), \
+                             'date' : df_history['date'].to_numpy(), \
+                             'position' : np.arange(len(df_history))})
+    df_first = df_first[df_first['package_id'].to_numpy() >= 0]
+    df_first = df_first.drop_duplicates(subset=['package_id', 'date'], keep='first')
+    # ------------------------ END FIRST HISTORY ENTRIES ------------------------------------>
+    
+    # ------------------------------- KEYED JOIN -------------------------------------------->
+    # all the unique package IDs from the history dataframe
+    history_idx = pd.unique(df_first['package_id'])
+    
+    # only PLD rows of packages that are in the history
+    df_keys = pd.DataFrame({'package_id' : df_pld['package_id'].to_numpy(), \
+                            'date' : df_pld['date'].to_numpy()})
+    in_history = df_keys['package_id'].isin(history_idx)
+    df_keys = df_keys[in_history.to_numpy()]
+    df_values = df_pld[in_history.to_numpy()]
+    
+    # join the PLD rows to their history entry on the integer dates, the left join keeps the PLD row order
+    df_match = df_keys.merge(df_first, how='left', on=['package_id', 'date'])
+    matched = df_match['position'].notna().to_numpy()
+    
+    # the last PLD row for a history entry is the one merged
+    df_matched = pd.DataFrame({'position' : df_match['position'].to_numpy()[matched].astype('int'), \
+                               'row' : np.arange(len(df_match))[matched]})
+    df_matched = df_matched.drop_duplicates(subset=['position'], keep='last')
+    positions = df_matched['position'].to_numpy()
+    rows = df_matched['row'].to_numpy()
+    
+    # gather the PLD values into the blank columns
+    array_provider[positions] = df_values['provider'].to_numpy(dtype='object')[rows]
+    array_assigned_area[positions] = df_values['assigned_area'].to_numpy()[rows]
+    array_loaded_area[positions] = df_values['loaded_area'].to_numpy()[rows]
+    array_zipcode[positions] = df_values['zipcode'].to_numpy()[rows]
+    
+    # insert new columns into the history dataframe
     merged_dataframe.insert(loc=len(merged_dataframe.columns), column='provider', value=array_provider)
     merged_dataframe.insert(loc=len(merged_dataframe.columns), column='assigned_area', value=array_assigned_area)
     merged_dataframe.insert(loc=len(merged_dataframe.columns), column='loaded_area', value=array_loaded_area)
     merged_dataframe.insert(loc=len(merged_dataframe.columns), column='zipcode', value=array_zipcode)
+    # ---------------------------- END KEYED JOIN ------------------------------------------->
     
-    # ------------------------------------------- MERGING CODE ------------------------------>
-    print("Merging df_history and df_pld...")
+    # ------------------------------- MERGE ERRORS ------------------------------------------>
+    # PLD rows with no history entry for their date (anti-join)
+    df_unmatched = df_match[~matched]
     
-    # error tracking for the loop below
-    merge_error_log = []
-    errors = 0
-    pkg_error = False
-    
-    pbar = tqdm(history_idx)
-    pbar.set_description('Errors 0')
-    # loop over all the individual packages in history
-    for i in pbar:
-        # collect and reset error
-        if pkg_error == True:           
-            pkg_error = False
-            pbar_error = 'Errors ' + str(errors)
-            pbar.set_description(pbar_error)
-    
-        # get the package's history
-        pkg_hist = df_history[df_history['package_id'] == i]
-        
-        # get the package's pld data
-        pkg_pld = df_pld[df_pld['package_id'] == i]
-        
-        # for each entry for the package in the PLD dataframe
-        for pld_row in pkg_pld.itertuples():
-            
-            # get the date for the PLD entry
-            date = pld_row.date
-          
-            try:
-                # get dataframe from package's history for the PLD date
-                pkg_hist_date = pkg_hist[pkg_hist['date'] == date]
-                
-                # get the first entry for date in package's history
-                index = pkg_hist_date.index[0]
-                
-                # merge data into the dataframe
-                merged_dataframe.at[index, 'provider'] = pld_row.provider
-                merged_dataframe.at[index, 'assigned_area'] = pld_row.assigned_area
-                merged_dataframe.at[index, 'loaded_area'] = pld_row.loaded_area
-                merged_dataframe.at[index, 'zipcode'] = pld_row.zipcode
-                
-            except Exception as err:
-                # set package error to true
-                pkg_error = True
-                errors += 1
-                
-                # log error
-                merge_error_log.append([i, date, err])                
-    # --------------------------------------- END MERGING CODE ------------------------------>
+    # order the errors by package as they appear in the history, then by PLD row
+    pkg_rank = pd.Series(np.arange(len(history_idx)), index=history_idx)
+    df_unmatched = df_unmatched.assign(rank=df_unmatched['package_id'].map(pkg_rank).to_numpy())
+    df_unmatched = df_unmatched.sort_values('rank', kind='stable')
+    
+    # log the errors with the package IDs of the surrogates
+    err = LookupError('No history entry for the PLD date')
+    ids = list(get_package_ids())
+    merge_error_log = [[ids[i] if 0 <= i < len(ids) else i, date, err] \
+                       for i, date in zip(df_unmatched['package_id'], df_unmatched['date'])]
+    # --------------------------- END MERGE ERRORS ------------------------------------------>
     
     # ----------------------------- CLEANUP AND TYPE CASTING -------------------------------->
-    # drop missing values
+    # drop missing values and rows without a package ID
     merged_dataframe = merged_dataframe.dropna()
+    merged_dataframe = merged_dataframe[merged_dataframe['package_id'].to_numpy() >= 0]
     
     # type casting for columns
     merged_dataframe.index = merged_dataframe.index.astype('int')    
-    merged_dataframe['package_id'] = merged_dataframe['package_id'].astype('string')    
-    merged_dataframe['order'] = merged_dataframe['order'].astype('int')    
-    merged_dataframe['date'] = merged_dataframe['date'].astype('string')   
-    merged_dataframe['dow'] = merged_dataframe['dow'].astype('string')   
-    merged_dataframe['station_code'] = merged_dataframe['station_code'].astype('int')   
-    merged_dataframe['driver_code'] = merged_dataframe['driver_code'].astype('int')   
-    merged_dataframe['reason'] = merged_dataframe['reason'].astype('int')            
-    merged_dataframe['zipcode'] = merged_dataframe['zipcode'].astype('int')    
-    merged_dataframe['provider'] = merged_dataframe['provider'].astype('string')    
-    merged_dataframe['assigned_area'] = merged_dataframe['assigned_area'].astype('int')
-    merged_dataframe['loaded_area'] = merged_dataframe['loaded_area'].astype('int')
+    merged_dataframe = apply_schema(merged_dataframe, 'merged')
     # ------------------------- END CLEANUP AND TYPE CASTING -------------------------------->
     
-    # set and save dataframe
-    set_dataframe(merged_dataframe, 'merged')
-    save_success = store_dataframes()
+    return merged_dataframe, merge_error_log
+# -------------------------------------------------------------------------------------------------------->
+# ---------------------------------------------- END MERGE DATA ------------------------------------------>
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+
+# -------------------------------------------------------------------------------------------------------->
+# ------------------------------------------ CODE TABLES ------------------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+class CodeMap:
+    """
+    CodeMap(recode_dict, sub_recode_dict) -> code_map (CodeMap)
     
-    #set and save error logs
-    set_error_log(merge_error_log, 'merge')
-    save_log_success = store_error_logs()
+    args:
+    recode_dict (dict) -> <recoded code : set of station and driver codes>
+    sub_recode_dict (dict) -> <recoded reason : reason code>
     
-    print("----------------------------------")
-    print("---------MERGE SUCCESS------------")
-    print("----------------------------------")
-    print("Merging completed.")
-    print("Merge errors:", errors)
-    print("\n\n")            
-    print("Dataframe saved successfully:", save_success)
-    print("Error log saved successfully:", save_log_success)
-    print("\n\n")
-    input("Press enter to continue...")
-   
+    returns:
+    code_map (CodeMap) -> compiled code tables
+    
+    Desc:
+    The recode dictionaries compiled into dense numpy lookup tables, indexed
+    by the raw code. Recoding a column is one gather from its table, codes
+    outside of the dictionaries (and outside of the table) recode to 0.
+    Works on any array of codes, so codes can be recoded when they are
+    parsed as well as in the cleaning.
+    """
+    def __init__(self, recode_dict, sub_recode_dict):
+        # table < station or driver code : recoded code >
+        self.code_table = self.compile_table({vv : k for k, v in recode_dict.items() for vv in v})
+        
+        # table < reason code : recoded reason >
+        self.reason_table = self.compile_table({v : k for k, v in sub_recode_dict.items()})
+        
+        
+    @staticmethod
+    def compile_table(mapping):
+        # zero filled table as long as the largest code, with the recoded values set
+        table = np.zeros(max(mapping) + 1, dtype='int64')
+        table[list(mapping.keys())] = list(mapping.values())
+        
+        return table
+        
+        
+    @staticmethod
+    def gather(table, codes):
+        # the recoded value of every code, 0 for codes not in the table
+        codes = np.asarray(codes).astype('int64')
+        inside = (codes >= 0) & (codes < len(table))
+        
+        return np.where(inside, table[np.where(inside, codes, 0)], 0)
+        
+        
+    def recode_codes(self, codes):
+        # recoded station or driver codes
+        return self.gather(self.code_table, codes)
+        
+        
+    def recode_reasons(self, reason, driver_code):
+        # recoded reasons, only driver code 2 keeps a reason
+        driver_code = np.asarray(driver_code)
+        reason = np.asarray(reason)
+        
+        # reasons that are not whole numbers are not in the table, they are not truncated
+        if reason.dtype.kind not in 'biu':
+            values = reason.astype('float64')
+            whole = np.isfinite(values) & (values == np.round(values))
+            reason = np.where(whole, values, -1)
+        
+        return np.where(driver_code == 2, self.gather(self.reason_table, reason), 0)
+        
+        
+    def recode(self, station_code, driver_code, reason):
+        # recode all three columns, the reason depends on the raw driver code
+        reason = self.recode_reasons(reason, driver_code)
+        driver_code = self.recode_codes(driver_code)
+        station_code = self.recode_codes(station_code)
+        
+        return station_code, driver_code, reason
+    
+    
+    
+    
+# the compiled code tables of the Recodes Lists
+CODE_MAP = CodeMap(RECODE_DICT, SUB_RECODE_DICT)
+# -------------------------------------------------------------------------------------------------------->
+# --------------------------------------- END CODE TABLES ------------------------------------------------>
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+
+# -------------------------------------------------------------------------------------------------------->
+# ------------------------------------------ PACKAGE INDEX ----------------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+class PackageIndex:
+    """
+    PackageIndex(df_history) -> pkg_index (PackageIndex)
+    
+    args:
+    df_history (dataframe) -> history dataframe
+    
+    returns:
+    pkg_index (PackageIndex) -> package index of the history
+    
+    Desc:
+    Package-grouped (CSR-style) index of a history dataframe, built in one pass.
+    'rows' lists the row positions of every package next to each other, in
+    their original row order, and 'offsets' gives where every package starts
+    and ends in it. Columns gathered in that order give zero-copy slices for
+    every package and per-package reductions. The dataframe is not reordered,
+    so row masks built from the index keep the original row order.
+    """
+    def __init__(self, df_history):
+        self.df = df_history
+        
+        # group number of every row, packages numbered by first appearance
+        self.codes = df_history.groupby('package_id', sort=False, dropna=False).ngroup().to_numpy()
+        
+        # row positions grouped by package, stable to keep the row order within a package
+        self.rows = np.argsort(self.codes, kind='stable')
+        
+        # number of rows of every package and where they start in 'rows'
+        self.sizes = np.bincount(self.codes).astype('int64')
+        self.offsets = np.zeros(len(self.sizes) + 1, dtype='int64')
+        np.cumsum(self.sizes, out=self.offsets[1:])
+        
+        # package ID of every group
+        self.packages = df_history['package_id'].to_numpy()[self.rows[self.offsets[:-1]]]
+        
+        # columns already gathered in package order
+        self.columns = {}
+        
+        
+    def __len__(self):
+        # number of packages
+        return len(self.sizes)
+        
+        
+    def gather(self, values):
+        # row-aligned values in package order
+        return np.asarray(values)[self.rows]
+        
+        
+    def column(self, name):
+        # a column in package order, gathered only once
+        if name not in self.columns:
+            self.columns[name] = self.gather(self.df[name].to_numpy())
+            
+        return self.columns[name]
+        
+        
+    def reduce(self, ufunc, values):
+        # per-package reduction of row-aligned values, e.g. np.add or np.maximum
+        return self.reduce_gathered(ufunc, self.gather(values))
+        
+        
+    def reduce_gathered(self, ufunc, values):
+        # per-package reduction of values already in package order
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.asarray(values).dtype)
+        
+        return ufunc.reduceat(values, self.offsets[:-1])
+        
+        
+    def any(self, row_mask):
+        # True for packages with any row in the mask
+        return self.reduce(np.logical_or, np.asarray(row_mask, dtype='bool'))
+        
+        
+    def all(self, row_mask):
+        # True for packages with every row in the mask
+        return self.reduce(np.logical_and, np.asarray(row_mask, dtype='bool'))
+        
+        
+    def first_rows(self):
+        # row position of the first entry of every package
+        return self.rows[self.offsets[:-1]]
+        
+        
+    def last_rows(self, row_mask=None):
+        # row position of the last entry of every package, or of the
+        # last entry in the mask (-1 if the package has none)
+        if row_mask is None:
+            return self.rows[self.offsets[1:] - 1]
+        
+        position = np.where(self.gather(np.asarray(row_mask, dtype='bool')), \
+                            np.arange(len(self.rows)), -1)
+        last = self.reduce_gathered(np.maximum, position)
+        
+        return np.where(last >= 0, self.rows[np.maximum(last, 0)], -1)
+        
+        
+    def expand(self, package_values):
+        # package-level values repeated for every row of the package
+        return np.asarray(package_values)[self.codes]
+        
+        
+    def blocks(self, columns=None):
+        # generator of (package_id, block) for every package, the block holds
+        # the package's row positions or zero-copy slices of the given columns
+        for i in range(len(self)):
+            start = self.offsets[i]
+            end = self.offsets[i+1]
+            
+            if columns is None:
+                block = self.rows[start:end]
+            else:
+                block = {c : self.column(c)[start:end] for c in columns}
+                
+            yield self.packages[i], block
+            
+            
+    def select(self, package_mask):
+        # the rows of the packages selected by a package-level mask
+        df = self.df[self.expand(package_mask)]
+        df.reset_index(drop=True, inplace=True)
+        
+        return df
+# -------------------------------------------------------------------------------------------------------->
+# --------------------------------------- END PACKAGE INDEX ---------------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+
+
+
+
+# -------------------------------------------------------------------------------------------------------->
+# ------------------------------------------ REFERENCE INDEX --------------------------------------------->
+# -------------------------------------------------------------------------------------------------------->
+class ReferenceIndex:
+    """
+    ReferenceIndex(df_history) -> ref (ReferenceIndex)
+    
+    args:
+    df_history (dataframe) -> history dataframe
+    
+    returns:
+    ref (ReferenceIndex) -> zipcode, area and provider lookups of the history
+    
+    Desc:
+    Lookup dictionaries between zipcodes, areas and providers, built from
+    ZIP_DICT and one grouped value count of the distinct (zipcode,
+    assigned_area, loaded_area, provider) combinations in the history.
+    Every dictionary holds the same values as a row by row pass over the
+    history would, the last row wins and 'provider_zip_dict' keeps the
+    first most frequent zipcode of every provider.
+    """
+    def __init__(self, df_history):
+        # the delivery area zip codes
+        self.zip_set = {z for zips in ZIP_DICT.values() for z in zips}
+        
+        # dictionary < zip code : provider >
+        self.zip_provider_dict = {}
+        for p, z in ZIP_DICT.items():
+            for zz in z:
+                self.zip_provider_dict[zz] = p
+        
+        # count every distinct combination once with its first and last row position
+        columns = ['zipcode', 'assigned_area', 'loaded_area', 'provider']
+        df = df_history[columns].reset_index(drop=True)
+        df['row'] = np.arange(len(df))
+        df = df.groupby(columns, sort=False, dropna=False, observed=True)['row'].agg(['size', 'min', 'max'])
+        df = df.reset_index()
+        
+        self.zip_area_dict = self.build_zip_area_dict(df)
+        self.area_provider_dict = self.build_area_provider_dict(df)
+        self.provider_zip_dict = self.build_provider_zip_dict(df)
+        
+        # dictionary < area : zip code >
+        self.area_zip_dict = dict([(value, key) for key, value in self.zip_area_dict.items()])
+        
+        
+    def build_zip_area_dict(self, df):
+        # dictionary < zip code : area >, only for the delivery area zip codes
+        df = df[df['zipcode'].isin(self.zip_set)]
+        
+        # the loaded area overrides the assigned area of the same row
+        valid_assigned = (df['assigned_area'] != 999) & (df['assigned_area'] != 0)
+        valid_loaded = df['loaded_area'] != 0
+        area = df['loaded_area'].where(valid_loaded, df['assigned_area'])
+        
+        df = df.assign(area=area)[valid_assigned | valid_loaded]
+        
+        # the last row of every zip code wins, keys in order of their first row
+        last = df.sort_values('max').drop_duplicates('zipcode', keep='last')
+        first = df.groupby('zipcode', sort=False)['min'].min()
+        last = last.assign(first=last['zipcode'].map(first)).sort_values('first')
+        
+        return dict(zip(last['zipcode'], last['area']))
+        
+        
+    def build_area_provider_dict(self, df):
+        # dictionary < area : provider >, for rows with an area and a provider
+        df = df[(df['assigned_area'] != 0) & (df['assigned_area'] != 999) & (df['provider'] != '')]
+        
+        # the last row of every area wins
+        last = df.sort_values('max').drop_duplicates('assigned_area', keep='last')
+        
+        return dict(zip(last['assigned_area'], last['provider']))
+        
+        
+    def build_provider_zip_dict(self, df):
+        # number of rows with every zip code
+        frequency = df.groupby('zipcode')['size'].sum().to_dict()
+        
+        # dictionary < provider : most frequent zip code >
+        provider_zip_dict = {}
+        for p, z in ZIP_DICT.items():
+            best_frequency = 0
+            best_zipcode = 0
+            
+            for zz in z:
+                if frequency.get(zz, 0) > best_frequency:
+                    best_frequency = frequency[zz]
+                    best_zipcode = zz
+                    
+            provider_zip_dict[p] = best_zipcode
+            
+        return provider_zip_dict
 # -------------------------------------------------------------------------------------------------------->
-# ---------------------------------------------- END MERGE DATA ------------------------------------------>
+# --------------------------------------- END REFERENCE INDEX -------------------------------------------->
 # -------------------------------------------------------------------------------------------------------->
 
 
@@ -1588,40 +3224,15 @@ def history_merge_pld():
 # ------------------------------------------ CLEANING FUNCTIONS ------------------------------------------>
 # -------------------------------------------------------------------------------------------------------->
 def recode_history(df_history):
-    # make a copy of the history dataframe
-    df = df_history.copy()
+    # make a copy of the history dataframe, the columns are replaced so they can be shared
+    df = df_history.copy(deep=False)
     
-    # Sub recodes List
-    sub_recode_dict = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5, 6: 73, 7: 74}
+    # recode the codes and the sub codes through the code tables
+    station_code, driver_code, reason = CODE_MAP.recode(df['station_code'], df['driver_code'], df['reason'])
     
-    # Use default_dict so that codes other than recodes default to 0
-    default_sub_dict = defaultdict(lambda: 0)
-    for k, v in sub_recode_dict.items():
-        default_sub_dict[v] = k
-        
-    # do the sub recoding
-    for row in df_history.itertuples():
-        if row.driver_code == 2:
-            new_code = default_sub_dict[row.reason]
-            df.at[row.Index, 'reason'] = new_code
-        else:
-            df.at[row.Index, 'reason'] = 0
-
-
-    # Recodes List
-    recode_dict = {1: {1, 4, 7, 11, 36, 57, 59, 82, 83}, 2: {15, 34, 47, 94, 100}, 3: {40, 300},
-                   4: {33, 35, 42, 43, 51, 52, 53, 54, 56, 63, 67, 68}, 5: {12, 16, 27, 37},
-                   6: {2, 3, 17}, 7: {85}, 8: {6, 81}, 9: {10}}
-
-    # Use default_dict so that codes other than recodes default to 0
-    default_dict = defaultdict(lambda: 0)
-    for k, v in recode_dict.items():
-        for vv in v:
-            default_dict[vv] = k
-
-    # Do the recoding
-    for col in ["driver_code", "station_code"]:
-        df[col] = df[col].astype(int).apply(lambda x: default_dict[x])
+    df['reason'] = reason
+    df['driver_code'] = driver_code
+    df['station_code'] = station_code
 
     return df
   
@@ -1629,35 +3240,27 @@ def recode_history(df_history):
     
     
 def package_align_history(df_package, df_history): 
-    # make copies of the dataframes
-    df_package_aligned = df_package.copy()
-    df_history_aligned = df_history.copy()
-    
     # get the unique package IDs in both df_package and df_history
     hist_ids = pd.unique(df_history['package_id'])
     package_ids = pd.unique(df_package['package_id'])
     
-    # for every unique package id in df_package
-    pbar = tqdm(package_ids)
-    pbar.set_description("df_package")
-    for pkg in pbar:
-        # remove packages from df_package that are not in the df_history
-        if pkg not in hist_ids:
-            index = df_package_aligned[df_package_aligned['package_id'] == pkg].index
-            df_package_aligned = df_package_aligned.drop(index, axis=0)
-            
-    # for every unique package id in df_history
-    pbar = tqdm(hist_ids)
-    pbar.set_description("df_history")
-    for pkg in pbar:
-        # remove packages from df_history that are not in the df_package
-        if pkg not in package_ids:
-            indices = df_history_aligned[df_history_aligned['package_id'] == pkg].index        
-            df_history_aligned = df_history_aligned.drop(indices, axis=0)
+    # hashed membership of every row in the other dataframe's package IDs
+    package_keep = df_package['package_id'].isin(hist_ids).to_numpy()
+    history_keep = df_history['package_id'].isin(package_ids).to_numpy()
+    
+    # remove the packages not in the other dataframe with one filter each
+    df_package_aligned = df_package[package_keep]
+    df_history_aligned = df_history[history_keep]
+    
+    # report what was removed from both sides
+    for name, df, keep in [('df_package', df_package, package_keep), ('df_history', df_history, history_keep)]:
+        dropped_pkgs = df['package_id'][~keep].nunique()
+        dropped_rows = int((~keep).sum())
+        print(name + ":", dropped_pkgs, "packages removed,", dropped_rows, "rows removed")
     
     # reset the indices for both dataframes
-    df_history_aligned = df_history_aligned.reset_index(drop=True)
-    df_package_aligned = df_package_aligned.reset_index(drop=True)
+    df_history_aligned.reset_index(drop=True, inplace=True)
+    df_package_aligned.reset_index(drop=True, inplace=True)
     
     return df_package_aligned, df_history_aligned
     
@@ -1665,58 +3268,43 @@ def package_align_history(df_package, df_history):
     
     
 def remove_empty_pkg(df_history):
-    # get a copy of the history dataframe
-    df = df_history.copy()
+    # group the history by package
+    pkg_index = PackageIndex(df_history)
     
-    # get all the unique package IDs
-    history_idx = pd.unique(df_history['package_id'])
+    # if only entry or less is present in the package's history, remove package
+    keep = pkg_index.sizes > 1
     
-    # for every unique package in the history dataframe
-    for i in tqdm(history_idx):
-        # get the history for the package
-        df_pkg = df_history[df_history['package_id'] == i]
-        
-        # if only entry or less is present in the package's history, remove package
-        if len(df_pkg) <= 1:
-            indices = df_pkg.index
-            df = df.drop(indices, axis=0)
-            
-    # reset the dataframe indices
-    df = df.reset_index(drop=True)
+    # packages kept with the dataframe indices reset
+    df = pkg_index.select(keep)
     
     return df
     
     
     
     
+def out_of_range_rows(df_history):
+    # get the date ranges as yyyymmdd integers
+    start_date = date_to_int(get_start_date())
+    end_date = date_to_int(get_end_date())
+    
+    # rows with a date not in the date range
+    dates = df_history['date'].to_numpy()
+    out_of_range = (dates < start_date) | (dates > end_date)
+    
+    return out_of_range
+    
+    
+    
+    
 def remove_history_dates(df_history):
-    # get a copy of the history dataframe
-    df = df_history.copy()
-
-    # get the date ranges
-    start_date = get_start_date()
-    end_date = get_end_date()
+    # group the history by package
+    pkg_index = PackageIndex(df_history)
     
-    # get all the unique package IDs
-    history_idx = pd.unique(df_history['package_id'])
+    # if package contains dates not in data range, remove package
+    keep = ~pkg_index.any(out_of_range_rows(df_history))
     
-    # for every unique package in the history dataframe
-    for i in tqdm(history_idx):
-        # get the history for the package
-        df_pkg = df_history[df_history['package_id'] == i]
-        
-        # check all the dates for the package
-        for d in df_pkg['date']:           
-            pkg_date = str_to_date(d)   #datetime date from package history
-            
-            # if package contains dates not in data range, remove package
-            if pkg_date < start_date or pkg_date > end_date:
-                indices = df_pkg.index
-                df = df.drop(indices, axis=0)
-                break
-                
-    # reset the dataframe indices
-    df = df.reset_index(drop=True)
+    # packages kept with the dataframe indices reset
+    df = pkg_index.select(keep)
                 
     return df
     
@@ -1724,23 +3312,14 @@ def remove_history_dates(df_history):
     
     
 def remove_history_order(df_history):
-    # get a copy of the history dataframe
-    df = df_history.copy()
-
-    # get the unique package IDs
-    history_idx = pd.unique(df_history['package_id'])
+    # group the history by package
+    pkg_index = PackageIndex(df_history)
     
     # if the package 'order' index 0 is not present, remove package
-    for i in tqdm(history_idx):
-        # df of the current package's history
-        df_pkg = df_history[df_history['package_id'] == i]
-               
-        if 0 not in df_pkg['order'].values:
-            indices = df_pkg.index
-            df = df.drop(indices, axis=0)
-            
-    # reset the dataframe indices
-    df = df.reset_index(drop=True)
+    keep = pkg_index.any(df_history['order'].to_numpy() == 0)
+    
+    # packages kept with the dataframe indices reset
+    df = pkg_index.select(keep)
     
     return df
     
@@ -1748,281 +3327,183 @@ def remove_history_order(df_history):
     
     
 
+def delivery_rows(pkg_index, delivery):
+    # the grouped history dataframe
+    df_history = pkg_index.df
+    
+    # the row of the last delivery status of every package (-1 if none)
+    last_delivery_row = pkg_index.last_rows(delivery)
+    has_delivery = last_delivery_row >= 0
+    
+    # get the last order index with 'Delivery' status
+    order = df_history['order'].to_numpy()
+    last_delivery = np.where(has_delivery, order[np.maximum(last_delivery_row, 0)], 0)
+    
+    # the rows after the last delivery status
+    after_delivery = pkg_index.expand(has_delivery) & (order > pkg_index.expand(last_delivery))
+    
+    # the last row of the packages without a delivery status
+    no_delivery = np.zeros(len(df_history), dtype='bool')
+    no_delivery[pkg_index.last_rows()[~has_delivery]] = True
+    
+    return after_delivery, no_delivery
+    
+    
+    
+    
 def truncate_pkg_history(df_history):
-    # get a copy of the history dataframe
-    df = df_history.copy()
+    # group the history by package
+    pkg_index = PackageIndex(df_history)
     
-    # get the unique package IDs
-    history_idx = pd.unique(df_history['package_id'])
+    # rows with 'Delivery' status
+    delivery = (df_history['type'] == 'Delivery').fillna(False).to_numpy(dtype='bool')
     
-    for i in tqdm(history_idx):
-        # df of the current package's history
-        df_pkg = df_history[df_history['package_id'] == i]
-        
-        # if there is any 'Delivery' status for the package
-        if 'Delivery' in df_pkg['type'].values:
-            #get order indices of when the package has 'Delivery' status
-            pkg_delivery = df_pkg.query("type=='Delivery'")['order'].values
-            
-            # get the last order index with 'Delivery' status
-            last_delivery = pkg_delivery[len(pkg_delivery)-1]
-            
-            # get any indices that might occur after last 'Delivery' status
-            index_after_delivery = df_pkg[df_pkg['order'] > last_delivery].index
-            
-            # remove those indices after the last 'Delivery' status
-            df = df.drop(index_after_delivery, axis=0)
+    # remove the indices after the last 'Delivery' status
+    after_delivery, no_delivery = delivery_rows(pkg_index, delivery)
+    df = df_history[~after_delivery]
     
     # reset the dataframe indices
-    df = df.reset_index(drop=True)
+    df.reset_index(drop=True, inplace=True)
     
     return df
     
     
     
     
+def fixed_assigned_area(df_history):
+    # the area columns
+    loaded_area = df_history['loaded_area'].to_numpy()
+    assigned_area = df_history['assigned_area'].to_numpy()
+    
+    # rows with a 'loaded_area' value of more than 3 digits
+    fix = loaded_area >= 1000
+    
+    # that also have a 'assigned_area' value matching its 3 first digits
+    fix &= (assigned_area != 0) & (loaded_area // 10 == assigned_area)
+    
+    # correct 'assigned_area' by replacing with 'loaded_area' values
+    return np.where(fix, loaded_area, assigned_area)
+    
+    
+    
+    
 def fix_area_digits(df_history):
-    # get a copy of the history dataframe
-    df = df_history.copy()
+    # get a copy of the history dataframe, the columns are replaced so they can be shared
+    df = df_history.copy(deep=False)
+    
+    # correct the 'assigned_area' column
+    df['assigned_area'] = fixed_assigned_area(df)
+        
+    return df
     
-    # narrow down to rows with a 'loaded_area' value
-    df_area = df[df['loaded_area'].values != 0]
     
-    # narrow down to rows with 'loaded_area' digits is more than 3
-    df_area = df_area[(np.floor(np.log10(df_area['loaded_area'].values))+1).astype('int') > 3]
     
-    # narrow down to rows that also has a 'assigned_area' value
-    df_area = df_area[df_area['assigned_area'].values != 0]
     
-    # narrow down to rows where 'assigned_area' and 'loaded_area' has matching 3 digits
-    df_area = df_area[df_area['loaded_area'].values // 10 == df_area['assigned_area'].values]
+def cascade_fill(column, rows, fallbacks):
+    # get a copy of the column
+    values = column.copy()
     
-    # correct 'assigned_area' by replacing with 'loaded_area' values
-    for i in df_area.itertuples():
-        index = i.Index
-        value = i.loaded_area
+    # rows still waiting for a value
+    remaining = rows.copy()
+    
+    # fallbacks in order of preference, every one as (available rows, lookup keys, dictionary)
+    for available, keys, lookup in fallbacks:
+        # rows filled by this fallback
+        hit = remaining & available
         
-        df.at[index, 'assigned_area'] = value
+        # look up the new values, a missing key is an error like a dictionary lookup
+        candidates = keys[hit].astype('object').map(lookup)
+        missing = candidates.isna().to_numpy()
+        if missing.any():
+            raise KeyError(keys[hit][missing].iloc[0])
         
-    return df
+        # categorical columns need the new values as categories first
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            new_values = pd.unique(candidates[~candidates.isin(values.cat.categories)])
+            values = values.cat.add_categories(new_values)
+        
+        # set the values and move on with the rows left
+        values[hit] = candidates
+        remaining &= ~hit
+        
+    return values
     
     
     
     
-def fix_zipcode_provider(df_history):
-    # get a copy of the history dataframe
-    df = df_history.copy()
+def impute_zipcode_provider(df_history, ref=None):
+    # get a copy of the history dataframe, the columns are replaced so they can be shared
+    df = df_history.copy(deep=False)
     
-    # original zip code dictionary
-    zip_dict = { \
-        'H': [65604, 65605, 65612, 65613, 65617, 65635, 65645, 65646, 65661, \
-              65663, 65664, 65674, 65682, 65707, 65710, 65712, 65721, 65725, \
-              65727, 65752, 65769, 65770, 65767, 65803, 65804], \
-        'B': [65590, 65622, 65632, 65644, 65648, 65685, 65706, 65713, 65722, \
-              65757, 65764, 65783, 65786, 65787, 65667, 65662, 65767], \
-        'C': [65608, 65614, 65618, 65620, 65627, 65629, 65637, 65638, 65653, \
-              65655, 65657, 65666, 65676, 65679, 65680, 65701, 65715, 65720, \
-              65729, 65731, 65733, 65741, 65744, 65753, 65755, 65759, 65760, \
-              65761, 65762, 65768], \
-        'F': [65610, 65631, 65705, 65738, 65781, 65633, 65619, 65802, 65803, 65807], \
-        'A': [65611, 65615, 65616, 65624, 65630, 65641, 65656, 65658, 65669, \
-              65672, 65675, 65681, 65686, 65726, 65728, 65737, 65739, 65740, \
-              65747, 65754, 65771], \
-        'K': [65609, 65626, 65660, 65689, 65766, 65775, 65776, 65777, 65788, \
-              65789, 65790, 65793], \
-        'D': [64738, 64776, 65324, 65326, 65355, 65601, 65603, 65634, 65640, \
-              65649, 65650, 65668, 65724, 65732, 65735, 65774, 65779, 65785, \
-              64781, 65607], \
-        'G': [65742, 65765, 65809, 65802, 65807, 65804], \
-        'J': [65714, 65801, 65806, 65808, 65810, 65897, 65898, 65899, 65619, \
-            65802, 65803, 65804, 65807], \
-        'E': [65636, 65652, 65702, 65704, 65711, 65717, 65746]}
-    
-    #<---------------------------BUILD DICTIONARIES---------------------------->
-    # the base zip code list
-    zip_list = []
-    
-    # build the zip list
-    for p, z in zip_dict.items():
-        for zz in z:
-            zip_list.append(zz)
-    
-    # dictionary <zip code : area >
-    zip_area_dict = {}
-    
-    # dictionary <zip code : area >
-    area_provider_dict = {}
-    
-    # build the zip_area_dict and area_provider_dict
-    # based on the zipcodes and areas inside the data
-    for row in df_history.itertuples():
-        if row.zipcode in zip_list:
-            
-            if row.assigned_area != 999 and row.assigned_area != 0:
-                zip_area_dict[row.zipcode] = row.assigned_area
-            
-            if row.loaded_area != 0:
-                zip_area_dict[row.zipcode] = row.loaded_area 
-                
-        if row.assigned_area and row.provider:
-            if row.assigned_area != 999:
-                area_provider_dict[row.assigned_area] = row.provider
-                
-    # dictionary < area : zip code >
-    area_zip_dict = dict([(value, key) for key, value in zip_area_dict.items()])
-    
-    # dictionary < zip code : provider >
-    zip_provider_dict = {}
-    for p, z in zip_dict.items():
-        for zz in z:
-            zip_provider_dict[zz] = p
-        
-    # dictionary < provider : zip code >
-    provider_zip_dict = {}    
-    pbar = tqdm(zip_dict.items())
-    for p, z in pbar:
-        best_frequency = 0
-        best_zipcode = 0
-        
-        for zz in z:
-            pbar.set_description(str(zz))
-            frequency = 0
-            
-            for row in df_history.itertuples():
-                if row.zipcode == zz:
-                    frequency += 1
-                    
-            if frequency > best_frequency:
-                best_frequency = frequency
-                best_zipcode = zz
-                
-        provider_zip_dict[p] = best_zipcode
-    #<---------------------------DICTIONARIES COMPLETE------------------------->    
+    # zipcode, area and provider lookups built from the history, unless they
+    # were already built from the whole history for a shard of it
+    if ref is None:
+        ref = ReferenceIndex(df_history)
+    
+    # the original columns, every fix looks at the values before any fixes
+    zipcode = df_history['zipcode']
+    provider = df_history['provider']
+    assigned_area = df_history['assigned_area']
+    loaded_area = df_history['loaded_area']
     
+    # rows with a value for each column
+    has_zipcode = (zipcode != 0).to_numpy()
+    has_assigned = (assigned_area != 0).to_numpy()
+    has_loaded = (loaded_area != 0).to_numpy()
+    has_provider = (provider != '').fillna(False).to_numpy(dtype='bool')
+    none_provider = (provider == 'None').fillna(False).to_numpy(dtype='bool')
     
     #<---------------------------FIX ZIPCODES/PROVIDERS------------------------>
-    # iterate over all the rows in history dataframe
-    for row in df_history.itertuples():
-        # if the zipcode is not in the area
-        if row.zipcode and row.zipcode not in zip_list:
-            # if we have an assigned area and it's in our dictionary
-            if row.assigned_area and row.assigned_area in area_zip_dict:
-                # get estimated zipcode
-                zipcode = area_zip_dict[row.assigned_area]
-                
-                # set zipcode for the right index
-                df.at[row.Index, 'zipcode'] = zipcode
-                
-            # if we have a loaded area and it's in our dictionary    
-            elif row.loaded_area and row.loaded_area in area_zip_dict:
-                # get estimated zipcode
-                zipcode = area_zip_dict[row.loaded_area]
-                
-                # set zipcode for the right index
-                index = row.Index
-                df.at[row.Index, 'zipcode'] = zipcode
-            
-            # if all else fails, use the provider
-            elif row.provider != 'None':
-                # set zipcode most frequent for provider
-                zipcode = provider_zip_dict[row.provider]
-                
-                # set zipcode for the right index
-                index = row.Index
-                df.at[row.Index, 'zipcode'] = zipcode
-        
-        # if we are missing the zipcode
-        if not row.zipcode and row.provider != '':
-            # if we have an assigned area and it's in our dictionary
-            if row.assigned_area and row.assigned_area in area_zip_dict:
-                # get estimated zipcode
-                zipcode = area_zip_dict[row.assigned_area]
-                
-                # set zipcode for the right index
-                df.at[row.Index, 'zipcode'] = zipcode
-                
-            # if we have a loaded area and it's in our dictionary    
-            elif row.loaded_area and row.loaded_area in area_zip_dict:
-                # get estimated zipcode
-                zipcode = area_zip_dict[row.loaded_area]
-                
-                # set zipcode for the right index
-                index = row.Index
-                df.at[row.Index, 'zipcode'] = zipcode
-            
-            # if all else fails, use the provider
-            elif row.provider != 'None':
-                # set zipcode most frequent for provider
-                zipcode = provider_zip_dict[row.provider]
-                
-                # set zipcode for the right index
-                index = row.Index
-                df.at[row.Index, 'zipcode'] = zipcode
-        
-        # if we are missing the provider
-        if row.provider == 'None':
-            
-            if row.assigned_area and row.assigned_area in area_provider_dict:
-                # get estimated provider
-                provider = area_provider_dict[row.assigned_area]
-                
-                # set provider for the right index
-                df.at[row.Index, 'provider'] = provider
-                
-            elif row.loaded_area and row.loaded_area in area_provider_dict:
-                # get estimated provider
-                provider = area_provider_dict[row.loaded_area]
-                
-                # set provider for the right index
-                df.at[row.Index, 'provider'] = provider
-                
-            elif row.zipcode:
-                # get estimated provider
-                provider = zip_provider_dict[row.zipcode]
-                
-                # set provider for the right index
-                df.at[row.Index, 'provider'] = provider
-        
-        # if we are missing the assigned area
-        if not row.assigned_area and row.provider != '':
-            
-            if row.zipcode and row.zipcode in zip_area_dict:
-                # get estimated area
-                area = zip_area_dict[row.zipcode]
-                
-                # set area for the right index
-                df.at[row.Index, 'assigned_area'] = area
+    # the zipcode is not in the area, or we are missing the zipcode
+    outside = has_zipcode & ~zipcode.isin(ref.zip_set).to_numpy()
+    missing = ~has_zipcode & has_provider
+    
+    # use the assigned area, then the loaded area, if all else fails use the provider
+    df['zipcode'] = cascade_fill(zipcode, outside | missing, [ \
+        (has_assigned & assigned_area.isin(list(ref.area_zip_dict)).to_numpy(), assigned_area, ref.area_zip_dict), \
+        (has_loaded & loaded_area.isin(list(ref.area_zip_dict)).to_numpy(), loaded_area, ref.area_zip_dict), \
+        (~none_provider, provider, ref.provider_zip_dict)])
+    
+    # if we are missing the provider, use the assigned area, then the loaded area, then the zipcode
+    df['provider'] = cascade_fill(provider, none_provider, [ \
+        (has_assigned & assigned_area.isin(list(ref.area_provider_dict)).to_numpy(), assigned_area, ref.area_provider_dict), \
+        (has_loaded & loaded_area.isin(list(ref.area_provider_dict)).to_numpy(), loaded_area, ref.area_provider_dict), \
+        (has_zipcode, zipcode, ref.zip_provider_dict)])
+    
+    # if we are missing the assigned area, use the zipcode
+    df['assigned_area'] = cascade_fill(assigned_area, ~has_assigned & has_provider, [ \
+        (has_zipcode & zipcode.isin(list(ref.zip_area_dict)).to_numpy(), zipcode, ref.zip_area_dict)])
     #<----------------------ZIPCODES/PROVIDERS COMPLETE------------------------>
     
-    # get unique package IDs
-    df_idx = pd.unique(df_history['package_id'])
-
-    # remove packages with their provider as 'None'
-    pbar = tqdm(df_idx)
-    pbar.set_description("Removing 'None' Provider")
-    for i in pbar:
-        df_pkg = df[df['package_id'] == i]
-        
-        if 'None' in df_pkg['provider'].values:
-            indices = df_pkg.index
-            df = df.drop(indices, axis=0)
-            
-            
-    # remove packages with no zipcodes
-    pbar = tqdm(df_idx)
-    pbar.set_description("Removing No Zipcode")
-    for i in pbar:
-        df_pkg = df[df['package_id'] == i]
-        
-        zips = pd.unique(df_pkg['zipcode'])
-        zips = [x for x in zips if x != 0]
-        
-        if len(zips) == 0:
-            indices = df_pkg.index
-            df = df.drop(indices, axis=0)
-            
-    # reset the index
-    df = df.reset_index(drop=True)
+    return df
+    
+    
+    
+    
+def unresolved_packages(pkg_index):
+    # the grouped history dataframe
+    df = pkg_index.df
+    
+    # packages with their provider as 'None'
+    none_provider = pkg_index.any((df['provider'] == 'None').fillna(False).to_numpy(dtype='bool'))
+    
+    # packages with no zipcodes
+    no_zipcode = pkg_index.all(df['zipcode'].to_numpy() == 0)
+    
+    return none_provider | no_zipcode
+    
+    
+    
+    
+def fix_zipcode_provider(df_history):
+    # resolve zipcodes, providers and areas from the rest of the history
+    df = impute_zipcode_provider(df_history)
+    
+    # group the history by package
+    pkg_index = PackageIndex(df)
+    
+    # remove packages still missing a provider or zipcode with the dataframe indices reset
+    df = pkg_index.select(~unresolved_packages(pkg_index))
     
     return df 
     
@@ -2030,11 +3511,27 @@ def fix_zipcode_provider(df_history):
     
     
 def type_to_status(df_history):
-    # make a copy of the history dataframe
-    df = df_history.copy()
+    # rename the column and shorten the status values into a new 'status' column
+    df = rename_status(df_history)
+    
+    # group the history by package
+    pkg_index = PackageIndex(df)
+    
+    # rows with a delivery status
+    delivery = (df['status'] == 'D').fillna(False).to_numpy(dtype='bool')
+    
+    # set no delivery status 'X' on the last entry of packages without a delivery status
+    after_delivery, no_delivery = delivery_rows(pkg_index, delivery)
+    df.loc[no_delivery, 'status'] = 'X'
+            
+    return df
+    
     
-    # rename the columns
-    df = df.rename(columns={'type' : 'status'})
+    
+    
+def rename_status(df_history):
+    # rename the columns, the other columns are shared
+    df = df_history.rename(columns={'type' : 'status'}, copy=False)
     
     # change 'Status Code' value to 'code'
     df['status'] = df['status'].str.replace('Status Code', 'S')
@@ -2042,27 +3539,130 @@ def type_to_status(df_history):
     # change 'Delivery' value to 'delivery'
     df['status'] = df['status'].str.replace('Delivery', 'D')
     
-    # get all the unique package IDs
-    history_idx = pd.unique(df_history['package_id'])
+    return df
+    
+    
+    
+    
+def fused_clean(df_package, df_history, ref=None):
+    # resolve zipcodes, providers and areas, the lookups need the whole history
+    df = impute_zipcode_provider(df_history, ref)
+    
+    # group the history by package once for every package-level rule
+    pkg_index = PackageIndex(df)
+    
+    # packages still missing a provider or zipcode
+    keep = ~unresolved_packages(pkg_index)
+    
+    # packages with only one entry or less
+    keep &= pkg_index.sizes > 1
+    
+    # packages with dates not in the date range
+    keep &= ~pkg_index.any(out_of_range_rows(df))
+    
+    # packages missing the 'order' index 0
+    keep &= pkg_index.any(df['order'].to_numpy() == 0)
+    
+    # packages not in df_package
+    package_ids = pd.unique(df_package['package_id'])
+    keep &= pd.Series(pkg_index.packages).isin(package_ids).to_numpy()
+    
+    # the rows after the last 'Delivery' status, and the last rows of packages
+    # without one that get the no delivery status 'X'
+    delivery = (df['type'] == 'Delivery').fillna(False).to_numpy(dtype='bool')
+    after_delivery, no_delivery = delivery_rows(pkg_index, delivery)
+    
+    # rows of the kept packages up to their last 'Delivery' status
+    rows = pkg_index.expand(keep) & ~after_delivery
+    df = df[rows]
+    no_delivery = no_delivery[rows]
+    
+    # reset the dataframe indices
+    df.reset_index(drop=True, inplace=True)
+    
+    # column transforms on the remaining rows
+    df = recode_history(df)
+    df['assigned_area'] = fixed_assigned_area(df)
+    df = rename_status(df)
+    df.loc[no_delivery, 'status'] = 'X'
+    
+    # keep the packages of df_package that are left in the history
+    df_package = df_package[df_package['package_id'].isin(pkg_index.packages[keep])]
+    df_package.reset_index(drop=True, inplace=True)
+    
+    return df_package, df
+    
+    
+    
+    
+def package_shards(df_package, df_history, shards):
+    # hash partition the packages by their interned IDs, every package
+    # lands in one shard with all its rows in both dataframes
+    package_shard = df_package['package_id'].to_numpy() % shards
+    history_shard = df_history['package_id'].to_numpy() % shards
+    
+    # the original row positions of every shard, in row order
+    return [(np.flatnonzero(package_shard == i), np.flatnonzero(history_shard == i)) for i in range(shards)]
+    
+    
+    
+    
+def clean_shard(df_package, df_history, ref, start_date, end_date):
+    # worker processes don't share our globals, set the date range first
+    set_start_date(start_date)
+    set_end_date(end_date)
+    
+    # every package-level rule only looks at the rows of its own package
+    return fused_clean(df_package, df_history, ref)
+    
+    
+    
+    
+def concat_shards(frames):
+    # concatenate the cleaned shards and put the rows back in their original order
+    df = pd.concat(frames, ignore_index=True)
+    order = np.argsort(df['row'].to_numpy(), kind='stable')
+    
+    df = df.take(order).drop(columns='row')
+    df.reset_index(drop=True, inplace=True)
     
-    # add a no delivery status as 'X' if no delivery status
-    for i in tqdm(history_idx):
-        # dataframe of the current package
-        df_pkg = df[df['package_id'] == i]
-        
-        # all the status values of the current package
-        status = df_pkg['status'].values
-        
-        # add no delivery status 'X' if delivery status not present
-        if 'D' not in status:
-            # get the index of the last entry for the package
-            indices = df_pkg.index
-            index = indices[len(indices)-1]
-            
-            # set no delivery status in our dataframe
-            df.at[index, 'status'] = 'X'
-            
     return df
+    
+    
+    
+    
+def parallel_clean(df_package, df_history):
+    # one shard per worker, without extra workers it is the fused cleaning
+    workers = get_workers()
+    if workers <= 1:
+        return fused_clean(df_package, df_history)
+    
+    # zipcode, area and provider lookups built once from the whole history
+    ref = ReferenceIndex(df_history)
+    
+    # the original row positions travel with the shards to restore the row order
+    df_package = df_package.assign(row=np.arange(len(df_package)))
+    df_history = df_history.assign(row=np.arange(len(df_history)))
+    shards = package_shards(df_package, df_history, workers)
+    
+    packages = []
+    histories = []
+    
+    # fan the shards out to the process pool
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(clean_shard, df_package.take(package_rows), df_history.take(history_rows), \
+                                   ref, get_start_date(), get_end_date()) for package_rows, history_rows in shards]
+        
+        # collect the results in shard order
+        pbar = tqdm(futures)
+        pbar.set_description('Shards (' + str(workers) + ' workers)')
+        for future in pbar:
+            df_package_shard, df_history_shard = future.result()
+            packages.append(df_package_shard)
+            histories.append(df_history_shard)
+    
+    # the shards concatenated in the original package and row order
+    return concat_shards(packages), concat_shards(histories)
 # -------------------------------------------------------------------------------------------------------->
 # -------------------------------------- END CLEANING FUNCTIONS ------------------------------------------>
 # -------------------------------------------------------------------------------------------------------->
@@ -2073,61 +3673,169 @@ def type_to_status(df_history):
 # -------------------------------------------------------------------------------------------------------->
 # ---------------------------------------------- CLEAN DATA ---------------------------------------------->
 # -------------------------------------------------------------------------------------------------------->
-def clean_data():
-    # get copies of the current built dataframes
-    df_package = get_dataframe('package')
-    df_history = get_dataframe('merged')
+def align_stage(df_package, df_history):
+    # package alignment is the only stage that changes df_package
+    return package_align_history(df_package, df_history)
     
-    print("Original df_package length:", len(df_package))
-    print("Original df_history length:", len(df_history))
-    print("\n\n")
     
-    # remove and resolve non-delivery area zipcodes
-    print("Process #1: Fixing zipcodes and Providers...")
-    df_history = fix_zipcode_provider(df_history)
-    print("Process #1 completed.", end='\n\n') 
     
-    # remove packages that don't have a history
-    print("Process #2: Removing packages with unusable histories...")
-    df_history = remove_empty_pkg(df_history)
-    print("Process #2 completed.", end='\n\n')
     
-    # enforce date range of all packages to be within the start and end date range
-    print("Process #3: Enforcing date range for the history dataframe...")
-    df_history = remove_history_dates(df_history)
-    print("Process #3 completed.", end='\n\n')
+def history_stage(function):
+    # a stage that only changes df_history
+    def stage(df_package, df_history):
+        return df_package, function(df_history)
+    
+    return stage
+    
+    
+    
     
+# cleaning stages in order [name, label, description, function (df_package, df_history)]
+CLEAN_STAGES = [ \
+    # remove and resolve non-delivery area zipcodes
+    ['zipcodes', "Process #1", "Fixing zipcodes and Providers", history_stage(fix_zipcode_provider)], \
+    # remove packages that don't have a history
+    ['empty', "Process #2", "Removing packages with unusable histories", history_stage(remove_empty_pkg)], \
+    # enforce date range of all packages to be within the start and end date range
+    ['dates', "Process #3", "Enforcing date range for the history dataframe", history_stage(remove_history_dates)], \
     # remove packages that have incorrect history ordering (missing 0th index)
     # some packages had weird 'Delivery' at first index, with date 9999/99/99
     # those packages are now missing the first index, we need to remove them
-    print("Process #4: Removing packages with ordering issues...")
-    df_history = remove_history_order(df_history)
-    print("Process #4 completed.", end='\n\n')
-    
+    ['order', "Process #4", "Removing packages with ordering issues", history_stage(remove_history_order)], \
     # truncate package histories to not show history after 'Delivery' status
-    print("Process #5: Truncating package histories after 'Delivery' status...")
-    df_history = truncate_pkg_history(df_history)
-    print("Process #5 completed.", end='\n\n')    
-    
+    ['truncate', "Process #5", "Truncating package histories after 'Delivery' status", history_stage(truncate_pkg_history)], \
     # convert the codes in the history dataframe
-    print("Process #6: Recoding the codes...")
-    df_history = recode_history(df_history)
-    print("Process #6 completed.", end='\n\n')     
-    
+    ['recode', "Process #6", "Recoding the codes", history_stage(recode_history)], \
     # fix the loaded_area attribute in history dataframe
-    print("Process #7: Fixing loaded_area digits in history dataframe...")
-    df_history = fix_area_digits(df_history)
-    print("Process #7 completed.", end='\n\n')    
-    
+    ['areas', "Process #7", "Fixing loaded_area digits in history dataframe", history_stage(fix_area_digits)], \
     # modify history 'type' attribute to show status
-    print("Process #8: Transforming 'type' attribute and adding no delivery status...")
-    df_history = type_to_status(df_history)
-    print("Process #8 completed.", end='\n\n')
-    
+    ['status', "Process #8", "Transforming 'type' attribute and adding no delivery status", history_stage(type_to_status)], \
     # we want to align df_package and df_history to have the same packages in them
-    print("Process #9: Aligning the package and history dataframes...")
-    df_package, df_history = package_align_history(df_package, df_history)
-    print("Process #9 completed.", end='\n\n')
+    ['align', "Process #9", "Aligning the package and history dataframes", align_stage]]
+
+# every process in one pass over the packages
+FUSED_STAGES = [['fused', "Processes #1-#9", "Cleaning the history in one pass", fused_clean]]
+
+# every process in one pass over package shards in parallel
+PARALLEL_STAGES = [['parallel', "Processes #1-#9", "Cleaning the history in parallel package shards", parallel_clean]]
+
+
+
+
+def run_stage(stage, df_package, df_history, audit=None):
+    # run one cleaning stage with its progress messages
+    name, label, description, function = stage
+    print(label + ": " + description + "...")
+    
+    # what goes into the stage and the usage before it
+    rows_in = len(df_history)
+    packages_in = df_history['package_id'].nunique()
+    package_rows_in = len(df_package)
+    wall_start = time.perf_counter()
+    cpu_start, rss_start = process_usage()
+    
+    df_package, df_history = function(df_package, df_history)
+    
+    # audit record of the stage, the peak memory only grows if the stage raised it
+    wall_end = time.perf_counter()
+    cpu_end, rss_end = process_usage()
+    if audit is not None:
+        audit.append({'stage' : name, 'label' : label, \
+                      'rows_in' : rows_in, 'rows_out' : len(df_history), \
+                      'packages_in' : packages_in, 'packages_out' : df_history['package_id'].nunique(), \
+                      'package_rows_in' : package_rows_in, 'package_rows_out' : len(df_package), \
+                      'wall_time' : wall_end - wall_start, 'cpu_time' : cpu_end - cpu_start, \
+                      'peak_rss_delta' : None if rss_start is None else rss_end - rss_start})
+    
+    print(label + " completed.", end='\n\n')
+    
+    return df_package, df_history
+    
+    
+    
+    
+def clean_steps(df_package, df_history):
+    # run every cleaning stage in order
+    for stage in CLEAN_STAGES:
+        df_package, df_history = run_stage(stage, df_package, df_history)
+    
+    return df_package, df_history
+    
+    
+    
+    
+def clean_data(fused=False, restart=None, pause=True, parallel=False):
+    # the cleaning stages to run
+    if parallel:
+        stages = PARALLEL_STAGES
+    elif fused:
+        stages = FUSED_STAGES
+    else:
+        stages = CLEAN_STAGES
+    names = [stage[0] for stage in stages]
+    
+    # a restart has to name one of the stages
+    if restart is not None and restart not in names:
+        print("Unknown cleaning stage:", restart)
+        print("Stages:", ', '.join(names))
+        print("\n\n")
+        if pause:
+            input("Press enter to continue...")
+        return False
+    
+    # get copies of the current built dataframes
+    df_package = get_dataframe('package')
+    df_history = get_dataframe('merged')
+    
+    # the history is cleaned after merging, a rebuild removes the merged history
+    if not isinstance(df_history, pd.DataFrame):
+        print("No merged history found, merge the dataframes first.")
+        print("\n\n")
+        if pause:
+            input("Press enter to continue...")
+        return False
+    
+    print("Original df_package length:", len(df_package))
+    print("Original df_history length:", len(df_history))
+    print("\n\n")
+    
+    # only our references are kept while cleaning, the stored dataframes get replaced
+    for df_type in DATAFRAME_TYPES:
+        release_dataframe(df_type)
+    
+    # the checkpoint key of every stage, chained from the input dataframes and the date range
+    input_key = hashlib.sha256(repr([CHECKPOINT_VERSION, frame_fingerprint(df_package), \
+                                     frame_fingerprint(df_history), str(get_start_date()), \
+                                     str(get_end_date())]).encode()).hexdigest()
+    keys = []
+    for name in names:
+        input_key = stage_key(name, input_key)
+        keys.append(input_key)
+        
+    # resume after the last stage with a checkpoint for the same input, before the restart stage
+    first = names.index(restart) if restart is not None else len(stages)
+    while first > 0:
+        frames = load_checkpoint(names[first-1], keys[first-1])
+        if frames is not None:
+            df_package, df_history = frames
+            print("Resuming after " + stages[first-1][1] + " from its checkpoint.", end='\n\n')
+            break
+        first -= 1
+    
+    # run the stages left and save a checkpoint after each of them, auditing every stage
+    audit = []
+    for index in range(first, len(stages)):
+        df_package, df_history = run_stage(stages[index], df_package, df_history, audit)
+        store_checkpoint(names[index], keys[index], df_package, df_history)
+        
+    # the audit of the stages run is saved with the error logs
+    if len(audit) != 0:
+        set_error_log(audit, 'clean')
+        store_error_logs()
+    
+    # the cleaning brings back wider types, compact them again
+    df_package = apply_schema(df_package, 'package')
+    df_history = apply_schema(df_history, 'merged')
     
     # set and save dataframe
     set_dataframe(df_package, 'package')
@@ -2143,7 +3851,24 @@ def clean_data():
     print("New df_package length:", len(df_package))
     print("New df_history length:", len(df_history))
     print("\n\n")
-    input("Press enter to continue...")
+    if pause:
+        input("Press enter to continue...")
+        
+    return True
+    
+    
+    
+    
+def clean_from_stage():
+    # ask the user which stage to restart the cleaning from
+    print("Which stage would you like to restart the cleaning from?")
+    print("Stages:", ', '.join([stage[0] for stage in CLEAN_STAGES + FUSED_STAGES + PARALLEL_STAGES]))
+    print("\n")
+    option = input(">: ").strip().lower()
+    print("\n\n")
+    
+    # the fused and parallel stages restart their own cleaning
+    clean_data(option == 'fused', option, True, option == 'parallel')
 # -------------------------------------------------------------------------------------------------------->
 # ---------------------------------------------- END CLEAN DATA ------------------------------------------>
 # -------------------------------------------------------------------------------------------------------->
@@ -2152,10 +3877,34 @@ def clean_data():
 
 
 def main(args):    
+    # headless cleaning without the menu: --clean [stage] [--fused | --parallel]
+    args = list(args)
+    headless = '--clean' in args
+    fused = '--fused' in args
+    parallel = '--parallel' in args
+    restart = None
+    if headless:
+        index = args.index('--clean')
+        if index + 1 < len(args) and not args[index+1].startswith('--'):
+            restart = args.pop(index+1)
+            
+    # date partitions of the history files: --partition day|month|none
+    if '--partition' in args:
+        index = args.index('--partition')
+        if index + 1 < len(args) and not args[index+1].startswith('--'):
+            set_partitions(args.pop(index+1))
+            
+    # the remaining arguments are the data path and the worker count
+    args = [a for a in args if not a.startswith('--')]
+    
     # check if custom file path is given
     if len(args) > 1:
         set_path(args[1], 'data')
     
+    # check if a worker count for parallel builds is given
+    if len(args) > 2:
+        set_workers(args[2])
+    
     # check file paths
     check_path()
     
@@ -2182,9 +3931,6 @@ def main(args):
     set_start_date(start_date)
     set_end_date(end_date)
     
-    start_string = "Start Date: " + str(start_date)
-    end_string = "End Date: " + str(end_date)
-    
     
     # load dataframes and error logs
     load_df_success = load_dataframes()
@@ -2201,11 +3947,17 @@ def main(args):
     else:
         print("No Error logs loaded.", end='\n\n')
         
+    # clean and exit without waiting for the user
+    if headless:
+        if load_df_success == False or not clean_data(fused, restart, False, parallel):
+            sys.exit(1)
+        return
+        
     # Wait for user to continue
     input("Press enter to continue...")
     
     # prompt the main menu
-    menu(start_string, end_string)
+    menu()
 
     
     
@@ -10,6 +10,12 @@ import numpy as np
 import math
 import random
 from tqdm import tqdm
+
+# compact column types of the compiled dataframes
+from schema import apply_schema
+
+# files of the compiled dataframes
+from storage import read_dataframe
 import warnings
 
 # ignore warnings
@@ -37,6 +43,9 @@ def transform(df_master):
     # drop the package ID, we don't need it anymore
     df = df.drop(columns='package_id')
     
+    # enumerate the categorical columns as plain values
+    df[['service', 'provider']] = df[['service', 'provider']].astype('object')
+    
     #----------------SERVICE------------------------->
     # build service array
     service_array = pd.unique(df['service'].values)
@@ -406,21 +415,21 @@ def main():
     if not os.path.exists(path):
         os.makedirs(path)
         print("No compiled dataframe directory found.")
-        print("Place pickled dataframes in \'compiled\'.")
+        print("The compiled dataframes are saved in \'compiled\' as column stores (.columns) or date partitions (.parts).")
         print("You may need to compile your dataframes first with preprocessor.py/merger.py.")
         input("Press enter to continue...")
         sys.exit()
         
-    # filename to look for
-    file_master = 'df_master.pkl'
+    # filename to look for, the master dataframe without its extension
+    file_master = 'df_master'
     
-    # load the data if it exists
+    # load the data if it exists, a column store is opened read-only without reading it
     try:
-        df_master = pd.read_pickle(path + file_master)
+        df_master = apply_schema(read_dataframe(path + file_master), 'master')
         
     except:
         print("No data found.")
-        print("Place pickled dataframes in \'compiled\'.")
+        print("Build the master dataframe (df_master) in \'compiled\' with merger.py first.")
         input("Press enter to continue...")
         sys.exit()
         
@@ -503,7 +512,7 @@ def main():
         sample.to_csv(path + sample_name + '.csv', index=False)
         
         # original non-converted samples
-        sample = reverse_transform(sample)
+        sample = apply_schema(reverse_transform(sample), 'sample')
         
         sample_name = "original_sample" + str(i)
         sample.to_csv(path + sample_name + '.csv', index=False)   
@@ -0,0 +1,97 @@
+"""
+schema
+
+Description:
+Compact column types for every compiled dataframe. Low-cardinality strings
+are categoricals and integers are as narrow as their values allow. The
+preprocessor applies the schema once when the dataframes are built, and
+every script enforces it again when it loads them.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# type of the yyyymmdd integer dates
+DATE_DTYPE = 'int32'
+
+# type of the interned package ID surrogates
+ID_DTYPE = 'int32'
+
+# column types of every dataframe <dataframe : <column : type>>
+# columns that are not listed keep their type
+SCHEMAS = {
+    'aggregate' : {'date' : DATE_DTYPE, 'provider' : 'category', 'area_counts' : 'int32', \
+                   'pkg_counts' : 'int32', 'pkg_returns' : 'int32', 'pkg_missing' : 'int32'},
+
+    'package' : {'package_id' : ID_DTYPE, 'service' : 'category', 'signature' : 'category'},
+
+    'history' : {'package_id' : ID_DTYPE, 'order' : 'int16', 'date' : DATE_DTYPE, \
+                 'dow' : 'category', 'type' : 'category', 'station_code' : 'int16', \
+                 'driver_code' : 'int16', 'reason' : 'int16'},
+
+    'pld' : {'package_id' : ID_DTYPE, 'zipcode' : 'int32', 'provider' : 'category', \
+             'assigned_area' : 'int32', 'loaded_area' : 'int32', 'station_code' : 'int16', \
+             'driver_code' : 'int16', 'date' : DATE_DTYPE},
+
+    'merged' : {'package_id' : ID_DTYPE, 'order' : 'int16', 'date' : DATE_DTYPE, \
+                'dow' : 'category', 'type' : 'category', 'status' : 'category', \
+                'station_code' : 'int16', 'driver_code' : 'int16', 'reason' : 'int16', \
+                'provider' : 'category', 'assigned_area' : 'int32', 'loaded_area' : 'int32', \
+                'zipcode' : 'int32'},
+
+    'master' : {'delivered' : 'bool', 'service' : 'category', 'signature' : 'bool', \
+                'zipcode' : 'int32', 'provider' : 'category', 'area' : 'int32', \
+                'days' : 'int16', 'delays' : 'int16', 'failures' : 'int16', \
+                'address' : 'int16', 'resolution' : 'bool', 'volume' : 'int32', \
+                'temp' : 'int16'},
+
+    'sample' : {'delivered' : 'bool', 'service' : 'category', 'signature' : 'bool', \
+                'zipcode' : 'int32', 'provider' : 'category', 'area' : 'int32', \
+                'days' : 'int16', 'delays' : 'int16', 'failures' : 'int16', \
+                'address' : 'int16', 'resolution' : 'bool'}}
+
+
+
+
+def apply_schema(df, df_type):
+    """
+    apply_schema(df, df_type) -> df (dataframe)
+
+    args:
+    df (dataframe) -> dataframe to cast
+    df_type (string) -> 'aggregate', 'package', 'history', 'pld', 'merged',
+                        'master' or 'sample'
+
+    returns:
+    df (dataframe) -> the same dataframe with its columns cast
+
+    Desc:
+    Cast the columns of a dataframe to the types of its schema. The columns
+    are replaced in place, only the ones not already of the right type.
+    Raises a ValueError if an integer column has values that do not fit
+    its narrow type.
+    """
+    for column, dtype in SCHEMAS[df_type].items():
+        # skip columns the dataframe does not have
+        if column not in df.columns:
+            continue
+
+        # skip columns that already match, categories are plain objects as they are read from files
+        if df[column].dtype == dtype and (dtype != 'category' or df[column].cat.categories.dtype == object):
+            continue
+
+        # narrow integers must hold all the values
+        if dtype.startswith('int') and len(df) > 0:
+            limits = np.iinfo(dtype)
+            values = pd.to_numeric(df[column])
+            if values.min() < limits.min or values.max() > limits.max:
+                raise ValueError(df_type + " column '" + column + "' does not fit " + dtype)
+
+        # string columns become categories of plain objects
+        if dtype == 'category':
+            df[column] = df[column].astype('object').astype(dtype)
+        else:
+            df[column] = df[column].astype(dtype)
+
+    return df
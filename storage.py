@@ -0,0 +1,745 @@
+"""
+storage
+
+Description:
+Files of the compiled dataframes. Dataframes are written as column stores,
+a directory with one memory-mapped numpy array per column and a small header
+describing them. String columns are dictionary encoded as integer codes with
+their distinct values in the header. Opening a store maps the columns without
+reading them, so only the columns that are used are paged in from the disk.
+Dataframes with columns that can't be stored this way are pickled.
+
+Dataframes with a 'date' column can also be split into date partitions, one
+column store per day or per month with an index of the partitions. Reading a
+date range only opens the partitions in it, and saving only writes the
+partitions that changed, so new days are added without rewriting old ones.
+
+Files are written to new names or to a temporary file that is renamed over
+the old one, so a crash while saving never leaves a half written dataframe
+behind, and dataframes that are still open keep reading their old columns.
+"""
+
+import os
+import json
+import hashlib
+import shutil
+import pickle
+import numpy as np
+import pandas as pd
+
+# columnar file format (optional, used by the parse cache and to read older feather files)
+try:
+    import pyarrow
+    import pyarrow.feather
+    COLUMNAR = True
+except ImportError:
+    COLUMNAR = False
+
+
+# extension of the column store directories and the name of their header
+STORE_EXTENSION = '.columns'
+STORE_HEADER = 'header.json'
+
+# bump when the column store layout changes
+STORE_VERSION = 1
+
+# extension of the date partition directories and the name of their index
+PARTITION_EXTENSION = '.parts'
+PARTITION_INDEX = 'index.json'
+
+# yyyymmdd dates are divided by the period to get the partition key (yyyymmdd or yyyymm)
+PARTITION_PERIODS = {'day' : 1, 'month' : 100}
+
+# bump when the date partition layout changes
+PARTITION_VERSION = 1
+
+
+
+
+def atomic_write(path, write):
+    """
+    atomic_write(path, write) -> None
+
+    args:
+    path (string) -> file to write
+    write (function) -> writes the contents into an open binary file
+
+    returns:
+    None
+
+    Desc:
+    Write a file through a temporary file in the same directory that is
+    renamed over the old file once it is complete.
+    """
+    temp_path = path + '.tmp'
+
+    try:
+        # write and flush the contents to the disk
+        with open(temp_path, 'wb') as handle:
+            write(handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        # replace the old file in one step
+        os.replace(temp_path, path)
+    finally:
+        # no temporary file is left behind on errors
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+
+
+def frame_fingerprint(df, index=True):
+    """
+    frame_fingerprint(df, index=True) -> fingerprint (string)
+
+    args:
+    df (dataframe) -> dataframe to hash
+    index (bool) -> include the index in the hash
+
+    returns:
+    fingerprint (string) -> sha256 hex digest
+
+    Desc:
+    Hash of the columns, their types and every row of a dataframe.
+    Categories are hashed by their values, not their codes.
+    """
+    sha = hashlib.sha256()
+    sha.update(repr([(c, str(t)) for c, t in df.dtypes.items()]).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=index).to_numpy().tobytes())
+
+    return sha.hexdigest()
+
+
+
+
+def remove_unused(path, used):
+    """
+    remove_unused(path, used) -> None
+
+    args:
+    path (string) -> directory to clean up
+    used (list) -> names of the files and directories to keep
+
+    returns:
+    None
+
+    Desc:
+    Remove every file and directory that is not used any more. Files
+    still mapped on Windows can't be removed and are left for next time.
+    """
+    for name in os.listdir(path):
+        if name in used:
+            continue
+
+        try:
+            if os.path.isdir(os.path.join(path, name)):
+                shutil.rmtree(os.path.join(path, name))
+            else:
+                os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+
+
+
+
+def encode_column(column):
+    """
+    encode_column(column) -> array (ndarray), entry (dict)
+
+    args:
+    column (series) -> dataframe column
+
+    returns:
+    array (ndarray) -> values or codes to save
+    entry (dict) -> how to decode the array, for the header
+
+    Desc:
+    Encode a column as one numpy array. Categories keep their codes, string
+    columns are dictionary encoded and other columns must be plain numpy
+    types. Raises a TypeError for columns that can't be stored this way.
+    """
+    # categories are already dictionary encoded
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        entry = {'kind' : 'category', 'values' : column.cat.categories.tolist(), \
+                 'ordered' : bool(column.cat.ordered)}
+        return column.cat.codes.to_numpy(), entry
+
+    # strings become codes into their distinct values
+    if column.dtype == object:
+        if pd.api.types.infer_dtype(column, skipna=False) not in ('string', 'empty'):
+            raise TypeError("column '" + str(column.name) + "' is not all strings")
+
+        codes, values = pd.factorize(column, sort=False)
+        return codes.astype('int32'), {'kind' : 'strings', 'values' : values.tolist()}
+
+    # numbers, booleans and dates are saved as they are
+    if not isinstance(column.dtype, np.dtype) or column.dtype.kind not in 'biufmM':
+        raise TypeError("column '" + str(column.name) + "' has type " + str(column.dtype))
+
+    return column.to_numpy(), {'kind' : 'array'}
+
+
+
+
+def decode_column(array, entry):
+    """
+    decode_column(array, entry) -> values (array)
+
+    args:
+    array (ndarray) -> memory-mapped array of the column
+    entry (dict) -> header entry of the column
+
+    returns:
+    values (array) -> column values for a dataframe
+
+    Desc:
+    Decode a memory-mapped column array. Plain arrays and the codes of
+    categories are used without copying them, string columns are
+    decoded into new object arrays.
+    """
+    if entry['kind'] == 'category':
+        categories = pd.Index(entry['values'], dtype=None if len(entry['values']) else object)
+        return pd.Categorical.from_codes(array, categories=categories, ordered=entry['ordered'])
+
+    if entry['kind'] == 'strings':
+        return np.asarray(entry['values'], dtype=object)[array]
+
+    return array
+
+
+
+
+def write_store(df, path):
+    """
+    write_store(df, path) -> None
+
+    args:
+    df (dataframe) -> dataframe to save
+    path (string) -> directory of the column store
+
+    returns:
+    None
+
+    Desc:
+    Save a dataframe as a column store. The columns are written to new
+    files and the header naming them replaces the old header last, then
+    the files of the old columns are removed. Raises a TypeError if a
+    column, the column names or the index can't be stored.
+    """
+    # column names are saved in the header, the index must be a range or numbers
+    if not df.columns.is_unique or not all(isinstance(c, str) for c in df.columns):
+        raise TypeError("column names must be unique strings")
+    if not isinstance(df.index, pd.RangeIndex) and df.index.dtype.kind not in 'iu':
+        raise TypeError("index has type " + str(df.index.dtype))
+
+    # encode every column before anything is written
+    arrays = []
+    header = {'version' : STORE_VERSION, 'rows' : len(df), 'columns' : []}
+    for name, column in df.items():
+        array, entry = encode_column(column)
+        arrays.append(array)
+        header['columns'].append(dict(entry, name=name))
+
+    # range indices are saved in the header, other indices as an array
+    if isinstance(df.index, pd.RangeIndex):
+        header['index'] = {'kind' : 'range', 'start' : df.index.start, 'step' : df.index.step}
+    else:
+        arrays.append(df.index.to_numpy())
+        header['index'] = {'kind' : 'array'}
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # new file names, so dataframes still mapping the old files are not changed
+    generation = os.urandom(4).hex()
+    files = [generation + '.' + str(i) + '.npy' for i in range(len(arrays))]
+    for file, array in zip(files, arrays):
+        with open(os.path.join(path, file), 'wb') as handle:
+            np.save(handle, np.ascontiguousarray(array), allow_pickle=False)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    for entry, file in zip(header['columns'] + [header['index']], files):
+        entry['file'] = file
+
+    # the new header switches the store to the new columns in one step
+    atomic_write(os.path.join(path, STORE_HEADER), lambda handle: handle.write(json.dumps(header).encode()))
+
+    # remove the old columns
+    remove_unused(path, files + [STORE_HEADER])
+
+
+
+
+def read_store(path, columns=None, writable=False):
+    """
+    read_store(path, columns=None, writable=False) -> df (dataframe)
+
+    args:
+    path (string) -> directory of the column store
+    columns (list) -> columns to open, all the columns if None
+    writable (bool) -> changes to the columns stay in memory instead of raising
+
+    returns:
+    df (dataframe) -> dataframe of memory-mapped columns
+
+    Desc:
+    Open a column store. The columns are memory-mapped, nothing is read
+    until it is used. Read-only columns raise a ValueError when they are
+    changed in place, writable columns are copied on write and never
+    change the files.
+    """
+    with open(os.path.join(path, STORE_HEADER), 'rb') as handle:
+        header = json.loads(handle.read().decode())
+
+    if header['version'] != STORE_VERSION:
+        raise ValueError(path + " has column store version " + str(header['version']))
+
+    mode = 'c' if writable else 'r'
+    entries = {entry['name'] : entry for entry in header['columns']}
+    if columns is None:
+        columns = [entry['name'] for entry in header['columns']]
+
+    # map the selected columns
+    data = {}
+    for name in columns:
+        entry = entries[name]
+        array = np.load(os.path.join(path, entry['file']), mmap_mode=mode, allow_pickle=False)
+        data[name] = decode_column(array, entry)
+
+    # the saved index
+    index = header['index']
+    if index['kind'] == 'range':
+        index = pd.RangeIndex(index['start'], index['start'] + index['step'] * header['rows'], index['step'])
+    else:
+        index = pd.Index(np.load(os.path.join(path, index['file']), mmap_mode=mode, allow_pickle=False))
+
+    # one block per column, without copy the arrays are not consolidated
+    return pd.DataFrame(data, index=index, copy=False)
+
+
+
+
+def partition_key(date, period):
+    """
+    partition_key(date, period) -> key (int or ndarray)
+
+    args:
+    date (int or ndarray) -> yyyymmdd integer dates
+    period (string) -> 'day' or 'month'
+
+    returns:
+    key (int or ndarray) -> yyyymmdd or yyyymm partition keys
+
+    Desc:
+    Get the partition keys of dates.
+    """
+    return date // PARTITION_PERIODS[period]
+
+
+
+
+def date_rows(df, start, end):
+    """
+    date_rows(df, start, end) -> df (dataframe)
+
+    args:
+    df (dataframe) -> dataframe with a yyyymmdd integer 'date' column
+    start (int) -> first yyyymmdd date, None for no lower limit
+    end (int) -> last yyyymmdd date, None for no upper limit
+
+    returns:
+    df (dataframe) -> the rows in the date range
+
+    Desc:
+    Select the rows of a date range. A default index is reset.
+    """
+    dates = df['date'].to_numpy()
+    rows = np.ones(len(df), dtype='bool')
+    if start is not None:
+        rows &= dates >= start
+    if end is not None:
+        rows &= dates <= end
+
+    range_index = isinstance(df.index, pd.RangeIndex)
+    df = df[rows]
+    if range_index:
+        df = df.reset_index(drop=True)
+
+    return df
+
+
+
+
+def read_partition_index(path):
+    """
+    read_partition_index(path) -> index (dict)
+
+    args:
+    path (string) -> directory of the date partitions
+
+    returns:
+    index (dict) -> partition index, None if there is none or it is outdated
+
+    Desc:
+    Load the index of the date partitions.
+    """
+    index = None
+    if os.path.isfile(os.path.join(path, PARTITION_INDEX)):
+        with open(os.path.join(path, PARTITION_INDEX), 'rb') as handle:
+            index = json.loads(handle.read().decode())
+
+        if index['version'] != PARTITION_VERSION:
+            index = None
+
+    return index
+
+
+
+
+def write_partitions(df, path, period):
+    """
+    write_partitions(df, path, period) -> None
+
+    args:
+    df (dataframe) -> dataframe with a yyyymmdd integer 'date' column
+    path (string) -> directory of the date partitions
+    period (string) -> 'day' or 'month'
+
+    returns:
+    None
+
+    Desc:
+    Save a dataframe as one column store per date partition. Partitions
+    with the same rows as their saved partition are kept, the others are
+    written to new directories. The index of the partitions, with the
+    partition key of every row to restore the row order, replaces the old
+    index last. Raises a TypeError if the dataframe can't be partitioned.
+    """
+    if 'date' not in df.columns or not pd.api.types.is_integer_dtype(df['date']):
+        raise TypeError("dataframe has no integer 'date' column")
+    if len(df) == 0:
+        raise TypeError("dataframe has no rows to partition")
+
+    # a default index is not saved, every partition gets its own
+    range_index = isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1
+
+    # the partition of every row, rows grouped by partition in their row order
+    keys = partition_key(df['date'].to_numpy(), period).astype('int32')
+    partition_keys, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    offsets = np.zeros(len(partition_keys) + 1, dtype='int64')
+    np.cumsum(np.bincount(inverse, minlength=len(partition_keys)), out=offsets[1:])
+
+    # the saved partitions that can be kept
+    old_index = read_partition_index(path)
+    saved = {}
+    if old_index is not None and old_index['period'] == period and old_index['range_index'] == range_index:
+        saved = {entry['key'] : entry for entry in old_index['partitions']}
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # new names, so dataframes still reading the old partitions are not changed
+    generation = os.urandom(4).hex()
+
+    partitions = []
+    for i, key in enumerate(partition_keys.tolist()):
+        df_partition = df.take(order[offsets[i]:offsets[i+1]])
+        if range_index:
+            df_partition = df_partition.reset_index(drop=True)
+
+        # an unchanged partition is not written again
+        fingerprint = frame_fingerprint(df_partition, not range_index)
+        if key in saved and saved[key]['fingerprint'] == fingerprint:
+            partitions.append(saved[key])
+            continue
+
+        store = str(key) + '-' + generation + STORE_EXTENSION
+        write_store(df_partition, os.path.join(path, store))
+        partitions.append({'key' : key, 'rows' : len(df_partition), 'store' : store, 'fingerprint' : fingerprint})
+
+    # the partition key of every row
+    keys_file = 'keys-' + generation + '.npy'
+    with open(os.path.join(path, keys_file), 'wb') as handle:
+        np.save(handle, keys, allow_pickle=False)
+        handle.flush()
+        os.fsync(handle.fileno())
+
+    # the new index switches to the new partitions in one step
+    index = {'version' : PARTITION_VERSION, 'period' : period, 'rows' : len(df), \
+             'range_index' : range_index, 'keys' : keys_file, 'partitions' : partitions}
+    atomic_write(os.path.join(path, PARTITION_INDEX), lambda handle: handle.write(json.dumps(index).encode()))
+
+    # remove the partitions that were replaced
+    remove_unused(path, [entry['store'] for entry in partitions] + [keys_file, PARTITION_INDEX])
+
+
+
+
+def read_partitions(path, columns=None, writable=False, start=None, end=None):
+    """
+    read_partitions(path, columns=None, writable=False, start=None, end=None) -> df (dataframe)
+
+    args:
+    path (string) -> directory of the date partitions
+    columns (list) -> columns to read, all the columns if None
+    writable (bool) -> not used, the partitions are always read into new arrays
+    start (int) -> first yyyymmdd date to read, from the first date if None
+    end (int) -> last yyyymmdd date to read, up to the last date if None
+
+    returns:
+    df (dataframe) -> the rows of the date range in their saved order
+
+    Desc:
+    Read the date partitions of a date range. Only the partitions in the
+    range are opened and their columns are gathered straight into their
+    saved row order, with the categories of every partition combined.
+    """
+    index = read_partition_index(path)
+    period = index['period']
+
+    # the partitions in the date range
+    partitions = [entry for entry in index['partitions'] \
+                  if (start is None or entry['key'] >= partition_key(start, period)) \
+                  and (end is None or entry['key'] <= partition_key(end, period))]
+    selected = {entry['key'] for entry in partitions}
+
+    # rows of month partitions are filtered on their dates, the date column is read for that
+    filter_dates = period != 'day' and (start is not None or end is not None)
+    read_columns = columns
+    if filter_dates and columns is not None and 'date' not in columns:
+        read_columns = list(columns) + ['date']
+
+    # an empty range still needs the columns and their types of a partition
+    frames = [read_store(os.path.join(path, entry['store']), read_columns) for entry in partitions]
+    if len(frames) == 0:
+        df = read_store(os.path.join(path, index['partitions'][0]['store']), columns).iloc[:0]
+        return df.reset_index(drop=True) if index['range_index'] else df
+
+    # the partition keys of the rows in the range, in their saved order
+    keys = np.load(os.path.join(path, index['keys']), mmap_mode='r', allow_pickle=False)
+    if len(selected) < len(index['partitions']):
+        keys = keys[np.isin(keys, list(selected))]
+
+    # the saved positions of the rows of every partition, in partition order
+    positions = np.argsort(keys, kind='stable')
+    offsets = np.zeros(len(frames) + 1, dtype='int64')
+    np.cumsum([len(frame) for frame in frames], out=offsets[1:])
+
+    # gather every column into its saved row order
+    data = {}
+    for column in frames[0].columns:
+        values = [frame[column] for frame in frames]
+
+        if all(isinstance(v.dtype, pd.CategoricalDtype) for v in values):
+            # one set of categories for all the partitions
+            combined = pd.api.types.union_categoricals(values, sort_categories=True)
+            codes = np.empty(len(keys), dtype=combined.codes.dtype)
+            codes[positions] = combined.codes
+            data[column] = pd.Categorical.from_codes(codes, dtype=combined.dtype)
+        else:
+            array = np.empty(len(keys), dtype=np.result_type(*[v.dtype for v in values]))
+            for i, v in enumerate(values):
+                array[positions[offsets[i]:offsets[i+1]]] = v.to_numpy()
+            data[column] = array
+
+    # the saved index, or a new default one
+    if index['range_index']:
+        row_index = pd.RangeIndex(len(keys))
+    else:
+        row_index = np.empty(len(keys), dtype=np.result_type(*[frame.index.dtype for frame in frames]))
+        for i, frame in enumerate(frames):
+            row_index[positions[offsets[i]:offsets[i+1]]] = frame.index.to_numpy()
+        row_index = pd.Index(row_index)
+
+    df = pd.DataFrame(data, index=row_index, copy=False)
+
+    # month partitions can hold dates out of the range
+    if filter_dates:
+        df = date_rows(df, start, end)
+        if read_columns is not columns:
+            df = df[columns]
+
+    return df
+
+
+
+
+def write_dataframe(df, path, partition=None):
+    """
+    write_dataframe(df, path, partition=None) -> file_format (string)
+
+    args:
+    df (dataframe) -> dataframe to save
+    path (string) -> file path without extension
+    partition (string) -> 'day' or 'month' to save date partitions, None for one file
+
+    returns:
+    file_format (string) -> 'partitions', 'columns' or 'pickle'
+
+    Desc:
+    Save a dataframe as date partitions if asked for, otherwise or if it
+    has no dates as a column store. Dataframes with columns that can't be
+    stored in one are pickled atomically. The files of the other formats
+    are removed so only the newest one is left.
+    """
+    file_format = None
+
+    # date partitions first, dataframes without dates can't be partitioned
+    if partition is not None:
+        try:
+            write_partitions(df, path + PARTITION_EXTENSION, partition)
+            file_format = 'partitions'
+        except TypeError:
+            file_format = None
+
+    # column store next, columns with mixed types can't be stored in one
+    if file_format is None:
+        try:
+            write_store(df, path + STORE_EXTENSION)
+            file_format = 'columns'
+        except TypeError:
+            file_format = None
+
+    if file_format is None:
+        atomic_write(path + '.pkl', lambda handle: pickle.dump(df, handle, protocol=pickle.HIGHEST_PROTOCOL))
+        file_format = 'pickle'
+
+    # remove the files of the other formats
+    remove_dataframe(path, file_format)
+
+    return file_format
+
+
+
+
+def remove_dataframe(path, keep=None):
+    """
+    remove_dataframe(path, keep=None) -> None
+
+    args:
+    path (string) -> file path without extension
+    keep (string) -> format whose files are kept, None to remove them all
+
+    returns:
+    None
+
+    Desc:
+    Remove the files a dataframe was saved in, in every format but keep.
+    """
+    for old_format, extension in [('partitions', PARTITION_EXTENSION), ('columns', STORE_EXTENSION)]:
+        if keep != old_format and os.path.isdir(path + extension):
+            shutil.rmtree(path + extension, ignore_errors=True)
+    for old_format, extension in [('feather', '.feather'), ('pickle', '.pkl')]:
+        if keep != old_format and os.path.isfile(path + extension):
+            os.remove(path + extension)
+
+
+
+
+def read_dataframe(path, columns=None, writable=False, start=None, end=None):
+    """
+    read_dataframe(path, columns=None, writable=False, start=None, end=None) -> df (dataframe)
+
+    args:
+    path (string) -> file path without extension
+    columns (list) -> columns to read, all the columns if None
+    writable (bool) -> column store columns can be changed in memory
+    start (int) -> first yyyymmdd date to read, None for no lower limit
+    end (int) -> last yyyymmdd date to read, None for no upper limit
+
+    returns:
+    df (dataframe) -> the saved dataframe
+
+    Desc:
+    Load a dataframe saved by write_dataframe, or as a feather file or
+    pickle by an older build. Column stores are opened memory-mapped and
+    read-only unless writable, feather files only read the selected
+    columns from the disk. With a date range only its rows are returned,
+    date partitions only read the partitions in the range. Raises a
+    FileNotFoundError if there is no file.
+    """
+    # date partitions select their rows themselves
+    if os.path.isfile(os.path.join(path + PARTITION_EXTENSION, PARTITION_INDEX)):
+        return read_partitions(path + PARTITION_EXTENSION, columns, writable, start, end)
+
+    # a date range needs the dates of the rows
+    date_range = start is not None or end is not None
+    read_columns = columns
+    if date_range and columns is not None and 'date' not in columns:
+        read_columns = list(columns) + ['date']
+
+    if os.path.isfile(os.path.join(path + STORE_EXTENSION, STORE_HEADER)):
+        df = read_store(path + STORE_EXTENSION, read_columns, writable)
+    elif os.path.isfile(path + '.feather'):
+        df = pyarrow.feather.read_table(path + '.feather', columns=read_columns).to_pandas()
+    elif os.path.isfile(path + '.pkl'):
+        df = pd.read_pickle(path + '.pkl')
+
+        # pickles are read whole, select the columns afterwards
+        if read_columns is not None:
+            df = df[read_columns]
+    else:
+        raise FileNotFoundError(path)
+
+    # the rows of the date range
+    if date_range:
+        df = date_rows(df, start, end)
+        if read_columns is not columns:
+            df = df[columns]
+
+    return df
+
+
+
+
+def dataframe_format(path):
+    """
+    dataframe_format(path) -> file_format (string)
+
+    args:
+    path (string) -> file path without extension
+
+    returns:
+    file_format (string) -> 'partitions', 'columns', 'feather' or 'pickle',
+                            None if there is no file
+
+    Desc:
+    Get the format a dataframe was saved in.
+    """
+    file_format = None
+    if os.path.isfile(os.path.join(path + PARTITION_EXTENSION, PARTITION_INDEX)):
+        file_format = 'partitions'
+    elif os.path.isfile(os.path.join(path + STORE_EXTENSION, STORE_HEADER)):
+        file_format = 'columns'
+    elif os.path.isfile(path + '.feather'):
+        file_format = 'feather'
+    elif os.path.isfile(path + '.pkl'):
+        file_format = 'pickle'
+
+    return file_format
+
+
+
+
+def dataframe_partitions(path):
+    """
+    dataframe_partitions(path) -> period (string)
+
+    args:
+    path (string) -> file path without extension
+
+    returns:
+    period (string) -> 'day' or 'month', None if the dataframe is not partitioned
+
+    Desc:
+    Get the period of the date partitions a dataframe was saved in.
+    """
+    index = None
+    if dataframe_format(path) == 'partitions':
+        index = read_partition_index(path + PARTITION_EXTENSION)
+
+    return None if index is None else index['period']